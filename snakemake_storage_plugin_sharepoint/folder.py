@@ -0,0 +1,84 @@
+"""Helpers for listing and transferring folder trees on SharePoint."""
+
+import concurrent.futures
+import dataclasses
+import datetime
+import pathlib
+from typing import Any, Callable, Iterable, Iterator, TypeVar
+
+__all__ = ["RemoteEntry", "list_view_xml", "parse_rows", "transfer_parallel"]
+
+T = TypeVar("T")
+
+# Maximum page size for the list view threshold of a default SharePoint farm.
+ROW_LIMIT = 5000
+
+
+@dataclasses.dataclass(frozen=True)
+class RemoteEntry:
+    """A file or folder in a SharePoint folder tree."""
+
+    path: str
+    is_folder: bool
+    size: int
+    mtime: float
+
+    def matches(self, local_path: pathlib.Path) -> bool:
+        """Determine whether the local file has the same size and timestamp."""
+        try:
+            stat = local_path.stat()
+        except FileNotFoundError:
+            return False
+        return stat.st_size == self.size and int(stat.st_mtime) == int(self.mtime)
+
+    def is_up_to_date_with(self, local_path: pathlib.Path) -> bool:
+        """Determine whether the remote file has the same size and is not older."""
+        stat = local_path.stat()
+        return stat.st_size == self.size and self.mtime >= int(stat.st_mtime)
+
+
+def list_view_xml(row_limit: int = ROW_LIMIT) -> str:
+    """Return the CAML view that recursively lists all files and folders."""
+    return (
+        "<View Scope='RecursiveAll'><ViewFields>"
+        "<FieldRef Name='FileRef'/><FieldRef Name='FSObjType'/>"
+        "<FieldRef Name='File_x0020_Size'/><FieldRef Name='Modified'/>"
+        f"</ViewFields><RowLimit Paged='TRUE'>{row_limit}</RowLimit></View>"
+    )
+
+
+def parse_rows(rows: Iterable[dict[str, Any]], root_url: str) -> Iterator[RemoteEntry]:
+    """Parse the rows of RenderListDataAsStream relative to the root folder."""
+    prefix = root_url.rstrip("/") + "/"
+    for row in rows:
+        file_ref: str = row["FileRef"]
+        if not file_ref.startswith(prefix):
+            continue
+        modified = row.get("Modified.") or row.get("Modified")
+        yield RemoteEntry(
+            path=file_ref[len(prefix) :],
+            is_folder=str(row.get("FSObjType")) == "1",
+            size=int(row.get("File_x0020_Size") or 0),
+            mtime=(
+                datetime.datetime.fromisoformat(modified).timestamp() if modified else 0
+            ),
+        )
+
+
+def transfer_parallel(
+    func: Callable[[T], Any], items: Iterable[T], max_workers: int
+) -> None:
+    """Call func for every item using at most max_workers threads.
+
+    The first exception raised by any of the calls is propagated after all running
+    transfers have finished, pending transfers are cancelled.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(func, item) for item in items]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
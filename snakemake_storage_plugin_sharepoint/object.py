@@ -1,21 +1,30 @@
 """Definition of the StorageObject for SharePoint."""
 
+import asyncio
 import dataclasses
 import datetime
+import json
+import os
+import pathlib
+import shutil
 import urllib.parse as urlparse
 from contextlib import contextmanager
-from functools import partial
 from typing import TYPE_CHECKING, Any, Generator, Literal, Optional
 
 import requests
 from snakemake_interface_common.exceptions import WorkflowError
 from snakemake_interface_common.logging import get_logger
+from snakemake_interface_storage_plugins.common import Operation
 from snakemake_interface_storage_plugins.io import IOCacheStorageInterface, Mtime
 from snakemake_interface_storage_plugins.storage_object import (
     StorageObjectRead,
     StorageObjectWrite,
 )
 
+from .folder import RemoteEntry, list_view_xml, parse_rows, transfer_parallel
+from .site import SharePointSite
+from .version import VersionInfo, VersionSelector
+
 if TYPE_CHECKING:
     from .provider import StorageProvider as StorageProviderBase
 else:
@@ -25,6 +34,7 @@ else:
 __all__ = ["StorageObject"]
 
 HTTPVerb = Literal["GET", "POST", "HEAD"]
+CHUNK_SIZE = 1024 * 1024
 logger = get_logger()
 
 
@@ -33,12 +43,14 @@ class QueryParseResult:
     library: str
     filepath: str
     overwrite: Optional[bool]
+    site: Optional[str] = None
+    is_directory: bool = False
+    version: Optional[VersionSelector] = None
 
 
 class StorageObject(StorageObjectRead, StorageObjectWrite):
     """Definition of a ReadWritable storage object."""
 
-    DIGEST_URL = "{site_url}/_api/contextinfo"
     GET_FILE_URL = (
         "{site_url}/_api/web/GetFolderByServerRelativeUrl('{folder}')/"
         "Files('{filename}')"
@@ -47,10 +59,34 @@ class StorageObject(StorageObjectRead, StorageObjectWrite):
         "{site_url}/_api/web/GetFolderByServerRelativeUrl('{folder}')/"
         "Files('{filename}')/$value"
     )
+    VERSIONS_URL = (
+        "{site_url}/_api/web/GetFolderByServerRelativeUrl('{folder}')/"
+        "Files('{filename}')/Versions"
+    )
+    DOWNLOAD_VERSION_URL = (
+        "{site_url}/_api/web/GetFolderByServerRelativeUrl('{folder}')/"
+        "Files('{filename}')/Versions({version_id})/$value"
+    )
     UPLOAD_FILE_URL = (
         "{site_url}/_api/web/GetFolderByServerRelativeUrl('{folder}')/"
         "Files/add(url='{filename}',overwrite={overwrite})"
     )
+    COPY_FILE_URL = (
+        "{site_url}/_api/web/GetFileByServerRelativeUrl('{source_url}')/"
+        "copyTo(strNewUrl='{target_url}',bOverWrite={overwrite})"
+    )
+    MOVE_FILE_URL = (
+        "{site_url}/_api/web/GetFileByServerRelativeUrl('{source_url}')/"
+        "moveTo(newUrl='{target_url}',flags={move_flags})"
+    )
+    GET_FOLDER_URL = (
+        "{site_url}/_api/web/GetFolderByServerRelativeUrl('{folder}/{filename}')"
+    )
+    ADD_FOLDER_URL = "{site_url}/_api/web/folders/add('{folder}/{filename}')"
+    LIST_FOLDER_URL = (
+        "{site_url}/_api/web/GetList(@listUrl)/RenderListDataAsStream"
+        "?@listUrl='{library_url}'"
+    )
     if TYPE_CHECKING:
         provider: StorageProviderBase
 
@@ -63,23 +99,30 @@ class StorageObject(StorageObjectRead, StorageObjectWrite):
     ):
         """Initialize the StorageObject and set type hints for custom attributes."""
         self.allow_overwrite: bool
+        self.site: SharePointSite
         self.site_url: str
         self.site_netloc: str
         self.library: str
         self.filepath: str
+        self.is_directory: bool
+        self.version: Optional[VersionSelector]
+        # ETag of the server file at the time the local copy was retrieved
+        self.retrieved_etag: Optional[str] = None
+        # Version metadata fetched from the server, which unlike the cached metadata
+        # tells whether the version was the current one
+        self._fetched_version: Optional[VersionInfo] = None
         super().__init__(query, keep_local, retrieve, provider)
 
     def __post_init__(self):
         """Populate the attributes defined in __init__."""
-        if (site_url := self.provider.settings.site_url) is None:
-            raise WorkflowError("No site URL specified")
-        parsed_site = urlparse.urlparse(site_url)
-        self.site_url = site_url.rstrip("/")
-        self.site_netloc = parsed_site.netloc
-
         parsed_query = self.parse_query(self.query)
+        self.site = self.provider.site(parsed_query.site)
+        self.site_url = self.site.url
+        self.site_netloc = self.site.netloc
         self.library = parsed_query.library
         self.filepath = parsed_query.filepath
+        self.is_directory = parsed_query.is_directory
+        self.version = parsed_query.version
         self.allow_overwrite = self.get_overwrite_state(
             parsed_query.overwrite, self.provider
         )
@@ -115,10 +158,20 @@ class StorageObject(StorageObjectRead, StorageObjectWrite):
                 overwrite = None
             case _:
                 raise WorkflowError(f"Invalid overwrite value: {overwrite_string}")
+        version = None
+        if "version" in querystring:
+            try:
+                version = VersionSelector.parse(querystring["version"][0])
+            except ValueError as e:
+                raise WorkflowError(f"Invalid version value: {e}") from None
+        path = parsed_query.path.lstrip("/")
         return QueryParseResult(
             library=parsed_query.netloc,
-            filepath=parsed_query.path.lstrip("/"),
+            filepath=path.rstrip("/"),
             overwrite=overwrite,
+            is_directory=path.endswith("/"),
+            version=version,
+            site=querystring.get("site", [None])[0],
         )
 
     async def inventory(self, cache: IOCacheStorageInterface):
@@ -127,85 +180,569 @@ class StorageObject(StorageObjectRead, StorageObjectWrite):
         Return as much existence and modification date information as possible.
         Only retrieve that information that comes for free given the current object.
         """
+        if self.is_directory:
+            name = str(self.local_path())
+            exists, mtime, size = self._directory_info()
+            cache.exists_in_storage[name] = exists
+            cache.mtime[name] = Mtime(storage=mtime)
+            cache.size[name] = size
+            return
+        if self.version is not None:
+            name = str(self.local_path())
+            info = self._version_info()
+            cache.exists_in_storage[name] = info is not None
+            cache.mtime[name] = Mtime(storage=info.mtime if info else 0)
+            cache.size[name] = info.size if info else 0
+            if (
+                self.retrieve
+                and info
+                and not self.provider.version_cache.has_content(
+                    self.local_suffix(), info
+                )
+            ):
+                self.provider.add_prefetch_candidate(self, info.size)
+            return
         with self.httpr(self.GET_FILE_URL) as r:
             name = str(self.local_path())
             file_info = FileInfo(r)
             cache.exists_in_storage[name] = file_info.exists()
             cache.mtime[name] = Mtime(storage=file_info.last_modified())
             cache.size[name] = file_info.size()
+            if self.retrieve and file_info.exists():
+                self.provider.add_prefetch_candidate(self, file_info.size())
 
     def get_inventory_parent(self) -> Optional[str]:
         """Get inventory parent, not implemented for SharePoint."""
         return None
 
     def cleanup(self):
-        """Cleanup the object, not implemented for SharePoint."""
-        pass
+        """Cleanup the object, discarding a prefetched copy that was never used."""
+        self.provider.discard_prefetched(self)
 
     def exists(self) -> bool:
         """Determine whether the queried file exists on the server."""
+        if self.is_directory:
+            return self._folder_exists(self.filepath)
+        if self.version is not None:
+            return self._version_info() is not None
         with self.httpr(self.GET_FILE_URL, "GET") as r:
             return FileInfo(r).exists()
 
     def mtime(self) -> float:
         """Determine the modification time of the file."""
+        if self.is_directory:
+            return self._directory_info()[1]
+        if self.version is not None:
+            return info.mtime if (info := self._version_info()) else 0
         with self.httpr(self.GET_FILE_URL, "GET") as r:
             return FileInfo(r).last_modified()
 
     def size(self) -> int:
         """Determine the size of the file."""
+        if self.is_directory:
+            return self._directory_info()[2]
+        if self.version is not None:
+            return info.size if (info := self._version_info()) else 0
         with self.httpr(self.GET_FILE_URL, "GET") as r:
             return FileInfo(r).size()
 
     def retrieve_object(self):
         """Copy the file from the server locally."""
-        self.local_path().parent.mkdir(parents=True, exist_ok=True)
-        with (
-            self.httpr(self.DOWNLOAD_FILE_URL, stream=True) as r,
-            self.local_path().open("wb") as fh,
-        ):
-            for chunk in r.iter_content():
-                fh.write(chunk)
+        if self.is_directory:
+            self._retrieve_directory()
+            return
+        if self.version is not None:
+            self._retrieve_version()
+            return
+        if (prefetched := self.provider.take_prefetched(self)) is not None:
+            logger.debug(f"Using prefetched copy of {self.query}")
+            path, self.retrieved_etag = prefetched
+            self.local_path().parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(path, self.local_path())
+        else:
+            self.retrieved_etag = self._download_content(self.local_path())
+        # Pinned versions are never registered, as the server only copies the current
+        # version of a file
+        self.provider.register_retrieved(self)
+
+    async def managed_retrieve(self):
+        """Copy the file from the server locally, respecting the rate limits.
+
+        Snakemake retrieves the inputs of the jobs that will run concurrently, but
+        retrieve_object blocks the event loop, so they are retrieved one by one. Each
+        retrieval first schedules its prefetch and yields once, so the others can
+        schedule theirs and download in the background in the meantime.
+        """
+        self.provider.prefetch_candidate(self)
+        await asyncio.sleep(0)
+        await super().managed_retrieve()
+
+    def _download_content(self, local_path: pathlib.Path) -> Optional[str]:
+        """Download the queried file or version and return the ETag of the file."""
+        if self.version is None:
+            return self._download_file(self.filepath, local_path)
+        self._download_version(local_path)
+        return None
+
+    def remote_etag(self) -> Optional[str]:
+        """Return the current ETag of the file on the server."""
+        with self.httpr(self.GET_FILE_URL) as r:
+            return FileInfo(r).etag()
 
     # The type: ignore is necessary because the return type is not compatible with the
     # base class:
     # https://github.com/snakemake/snakemake-interface-storage-plugins/pull/48
     def local_suffix(self) -> str:  # type: ignore
-        """Get the local filepath relative to the local storage directory."""
-        return "/".join([self.site_netloc, self.library, self.filepath])
+        """Get the local filepath relative to the local storage directory.
+
+        Pinned versions are stored in a folder named after the version next to the
+        file, so different versions of one file can exist side by side.
+        """
+        filepath = self.filepath
+        if self.version is not None:
+            folder, _, name = filepath.rpartition("/")
+            filepath = "/".join(
+                part for part in [folder, self.version.local_name(), name] if part
+            )
+        return "/".join([self.site.local_prefix(), self.library, filepath])
 
     def store_object(self):
         """Write the local copy to the server."""
-        logger.debug("Getting form digest value")
-        with self.httpr(self.DIGEST_URL, "POST") as r:
+        source = self._copy_source()
+        if source is not None and not source.is_unchanged_on_server():
+            source = None
+        self._store(source)
+
+    async def managed_store(self):
+        """Write the local copy to the server, respecting the rate limits.
+
+        Verifying the source of a server-side copy is a request of its own, so it
+        takes a separate token of the rate limiter.
+        """
+        try:
+            source = self._copy_source()
+            if source is not None:
+                async with self._rate_limiter(Operation.EXISTS):
+                    if not source.is_unchanged_on_server():
+                        source = None
+            async with self._rate_limiter(Operation.STORE):
+                self._store(source)
+        except Exception as e:
+            raise WorkflowError(
+                f"Failed to store output in storage {self.print_query}", e
+            ) from e
+
+    def _copy_source(self) -> Optional["StorageObject"]:
+        """Find a retrieved file on the same site with the contents of the output."""
+        if (
+            not self.provider.settings.server_side_copy
+            or self.version is not None
+            or self.is_directory
+            or not self.local_path().is_file()
+        ):
+            return None
+        return self.provider.find_retrieved(self.local_path(), self.site)
+
+    def is_unchanged_on_server(self) -> bool:
+        """Determine whether the server file still matches the retrieved file."""
+        # The server copies its current contents, which must still be the contents
+        # that were retrieved
+        return self.remote_etag() == self.retrieved_etag
+
+    def _store(self, source: Optional["StorageObject"]):
+        """Write the local copy, copying the verified source on the server if given."""
+        if self.version is not None:
+            raise WorkflowError(
+                f"Cannot store {self.query}, pinned versions are read-only"
+            )
+        if self.is_directory:
+            self._store_directory()
+            return
+        if self.local_path().is_dir():
+            raise WorkflowError(
+                f"Cannot store the folder {self.local_path()} as a file, add a "
+                f"trailing slash to the query to store a folder ({self.query}/)"
+            )
+        # Produced by this run, so a copy prefetched from the server is outdated
+        self.provider.discard_prefetched(self)
+        if source is not None:
+            logger.info(f"Copying {source.query} to {self.query} on the server")
+            self.copy_from(source)
+            return
+        logger.info(f"Uploading {self.query}")
+        self._upload_file(self.local_path(), self.filepath)
+
+    def copy_from(self, source: "StorageObject", move: bool = False):
+        """Let the server copy or move the source file to this location."""
+        if source.site is not self.site:
+            raise WorkflowError(
+                f"Cannot copy {source.query} to {self.query} on the server, "
+                "both must be on the same site"
+            )
+        if source.is_directory or self.is_directory:
+            raise WorkflowError("Server-side copies of folders are not supported")
+        if source.version is not None:
+            raise WorkflowError(
+                f"Cannot copy {source.query} on the server, only the current version "
+                "of a file can be copied"
+            )
+        if self.version is not None:
+            raise WorkflowError(
+                f"Cannot copy to {self.query}, pinned versions are read-only"
+            )
+        if "/" in self.filepath:
+            self._ensure_folder(self.filepath.rsplit("/", 1)[0])
+        headers = {"x-requestdigest": self.site.form_digest()}
+        with self.httpr(
+            self.MOVE_FILE_URL if move else self.COPY_FILE_URL,
+            "POST",
+            headers=headers,
+            url_fields={
+                "source_url": self.site.server_relative_url(
+                    source.library, source.filepath
+                ),
+                "target_url": self.site.server_relative_url(
+                    self.library, self.filepath
+                ),
+                # MoveOperations.overwrite
+                "move_flags": "1" if self.allow_overwrite else "0",
+            },
+        ) as r:
             try:
                 r.raise_for_status()
             except requests.HTTPError as e:
                 raise WorkflowError(
-                    f"Failed to get form digest value for {self.query}"
+                    f"Failed to {'move' if move else 'copy'} {source.query} to "
+                    f"{self.query} on the server\n"
+                    f"Response: {r.status_code} - {r.text}"
                 ) from e
 
-            digest_value = r.json()["d"]["GetContextWebInformation"]["FormDigestValue"]
-
-        headers = {"x-requestdigest": digest_value}
+    def _download_file(
+        self,
+        filename: str,
+        local_path: pathlib.Path,
+        mtime: Optional[float] = None,
+        version_id: Optional[int] = None,
+    ) -> Optional[str]:
+        """Download a file and return its ETag."""
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        url = (
+            self.DOWNLOAD_FILE_URL if version_id is None else self.DOWNLOAD_VERSION_URL
+        )
+        with (
+            self.httpr(
+                url,
+                stream=True,
+                url_fields={"filename": filename, "version_id": str(version_id)},
+            ) as r,
+            local_path.open("wb") as fh,
+        ):
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                fh.write(chunk)
+        if mtime is not None:
+            os.utime(local_path, (mtime, mtime))
+        return normalize_etag(r.headers.get("ETag"))
+
+    def _version_info(self) -> Optional[VersionInfo]:
+        """Return the metadata of the pinned version, cached forever once final."""
+        assert self.version is not None
+        name = self.local_suffix()
+        if (info := self.provider.version_cache.get(name)) is not None:
+            return info
+        now = datetime.datetime.now(datetime.timezone.utc)
+        info = self._fetched_version = self._fetch_version_info()
+        if info is not None and self.version.is_final(now):
+            self.provider.version_cache.put(name, info)
+        return info
+
+    def _fetch_version_info(self) -> Optional[VersionInfo]:
+        assert self.version is not None
+        current = self._current_version_info()
+        if current is None:
+            return None
+        # The current version is not part of the Versions collection
+        if (info := self.version.resolve(current, [])) is not None:
+            return info
+        with self.httpr(self.VERSIONS_URL) as r:
+            try:
+                r.raise_for_status()
+            except requests.HTTPError as e:
+                raise WorkflowError(
+                    f"Failed to get the versions of {self.query}\n"
+                    f"Response: {r.status_code} - {r.text}"
+                ) from e
+            history = [VersionInfo.from_version(d) for d in r.json()["d"]["results"]]
+        return self.version.resolve(None, history)
 
-        logger.info(f"Uploading {self.query}")
-        with open(self.local_path(), "rb") as file:
+    def _current_version_info(self) -> Optional[VersionInfo]:
+        with self.httpr(self.GET_FILE_URL) as r:
+            if not FileInfo(r).exists():
+                return None
+            return VersionInfo.from_file(r.json()["d"])
+
+    def _retrieve_version(self):
+        """Link the local copy to the cached version, downloading it on a cache miss."""
+        if (info := self._version_info()) is None:
+            raise WorkflowError(f"No version of {self.query} matches the query")
+        cache = self.provider.version_cache
+        name = self.local_suffix()
+        if cache.has_content(name, info):
+            logger.debug(f"Using cached copy of {self.query}")
+        elif (prefetched := self.provider.take_prefetched(self)) is not None:
+            logger.debug(f"Using prefetched copy of {self.query}")
+            cache.put_content(name, prefetched[0])
+        else:
+            path = cache.content_path(name)
+            download = path.with_name(f"{path.name}.download")
+            download.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                self._download_version(download)
+                cache.put_content(name, download)
+            finally:
+                download.unlink(missing_ok=True)
+        cache.link_content(name, self.local_path())
+
+    def _download_version(self, local_path: pathlib.Path):
+        if (info := self._version_info()) is None:
+            raise WorkflowError(f"No version of {self.query} matches the query")
+        fetched = self._fetched_version
+        if fetched is not None and fetched.current and fetched.label == info.label:
+            # The current version is not in the history, download it directly
+            self._download_file(self.filepath, local_path, info.mtime)
+            return
+        try:
+            self._download_file(self.filepath, local_path, info.mtime, info.id)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != requests.codes.not_found:
+                raise
+            # The version is not in the history, so it should be the current version
+            current = self._current_version_info()
+            if current is None or current.label != info.label:
+                raise WorkflowError(
+                    f"Version {info.label} of {self.query} no longer exists"
+                ) from e
+            self._download_file(self.filepath, local_path, info.mtime)
+
+    def _upload_file(self, local_path: pathlib.Path, filename: str) -> Optional[float]:
+        """Upload the local file and return its modification time on the server."""
+        if "/" in filename:
+            self._ensure_folder(filename.rsplit("/", 1)[0])
+        headers = {"x-requestdigest": self.site.form_digest()}
+        with open(local_path, "rb") as file:
             with self.httpr(
-                self.UPLOAD_FILE_URL, "POST", headers=headers, data=file.read()
+                self.UPLOAD_FILE_URL,
+                "POST",
+                headers=headers,
+                data=file.read(),
+                url_fields={"filename": filename},
             ) as r:
                 try:
                     r.raise_for_status()
                 except requests.HTTPError as e:
+                    if r.status_code == requests.codes.forbidden:
+                        # The digest may have expired early, get a new one on retry.
+                        self.site.invalidate_form_digest()
                     en_dis_abled = (
                         "enabled"
                         if self.allow_overwrite
                         else "disabled, allow by adding ?overwrite to the query"
                     )
                     raise WorkflowError(
-                        f"Failed to store {self.query} (overwrite is {en_dis_abled})\n"
+                        f"Failed to store {filename} in {self.library} "
+                        f"(overwrite is {en_dis_abled})\n"
+                        f"Response: {r.status_code} - {r.text}"
+                    ) from e
+                try:
+                    return FileInfo(r).last_modified()
+                except (ValueError, KeyError):
+                    return None
+
+    def _folder_exists(self, filename: str) -> bool:
+        with self.httpr(self.GET_FOLDER_URL, url_fields={"filename": filename}) as r:
+            return FolderInfo(r).exists()
+
+    def _folder_key(self, filename: str) -> str:
+        return self.site.server_relative_url(self.library, filename)
+
+    def _ensure_folder(self, filename: str, throttle: bool = False):
+        """Create the folder and its missing parents.
+
+        The folder itself is checked first, as it usually exists already, and its
+        parents are only checked when it is missing. Folders known to exist are cached
+        on the site, so every folder is checked and created at most once, no matter
+        how many files are uploaded into it. With throttle, every request waits for
+        the rate limiter, which is only allowed on worker threads.
+        """
+        key = self._folder_key(filename)
+        if self.site.is_known_folder(key):
+            return
+        # Locks are always taken from a folder towards its parents, never the other
+        # way around, so threads creating overlapping paths cannot deadlock.
+        with self.site.folder_lock(key):
+            if self.site.is_known_folder(key):
+                return
+            if throttle:
+                self.provider.throttle(self.query, Operation.EXISTS)
+            if self._folder_exists(filename):
+                # An existing folder implies that all its parents exist
+                parts = filename.split("/")
+                for depth in range(1, len(parts) + 1):
+                    self.site.add_known_folder(
+                        self._folder_key("/".join(parts[:depth]))
+                    )
+                return
+            if "/" in filename:
+                self._ensure_folder(filename.rsplit("/", 1)[0], throttle)
+            logger.debug(f"Creating folder {filename} in {self.library}")
+            if throttle:
+                self.provider.throttle(self.query, Operation.STORE)
+            self._add_folder(filename)
+            self.site.add_known_folder(key)
+
+    def _list_directory(self) -> list[RemoteEntry]:
+        """List all files and folders below the queried folder in one paged listing."""
+        root_url = self.site.server_relative_url(self.library, self.filepath)
+        body = json.dumps(
+            {
+                "parameters": {
+                    "__metadata": {"type": "SP.RenderListDataParameters"},
+                    "RenderOptions": 2,
+                    "DatesInUtc": True,
+                    "FolderServerRelativeUrl": root_url,
+                    "ViewXml": list_view_xml(),
+                }
+            }
+        )
+        headers = {"x-requestdigest": self.site.form_digest()}
+        entries: list[RemoteEntry] = []
+        params: dict[str, str] = {}
+        while True:
+            with self.httpr(
+                self.LIST_FOLDER_URL, "POST", headers=headers, data=body, params=params
+            ) as r:
+                try:
+                    r.raise_for_status()
+                except requests.HTTPError as e:
+                    raise WorkflowError(
+                        f"Failed to list {self.query}\n"
                         f"Response: {r.status_code} - {r.text}"
                     ) from e
+                page = r.json()
+            entries.extend(parse_rows(page.get("Row", []), root_url))
+            if not (next_href := page.get("NextHref")):
+                return entries
+            params = dict(urlparse.parse_qsl(next_href.lstrip("?")))
+
+    def _directory_info(self) -> tuple[bool, float, int]:
+        """Return existence, modification time and total size of the folder."""
+        with self.httpr(self.GET_FOLDER_URL) as r:
+            folder_info = FolderInfo(r)
+            if not folder_info.exists():
+                return False, 0, 0
+            folder_mtime = folder_info.last_modified()
+        files = [entry for entry in self._list_directory() if not entry.is_folder]
+        mtime = max([folder_mtime, *(entry.mtime for entry in files)])
+        return True, mtime, sum(entry.size for entry in files)
+
+    def _retrieve_directory(self):
+        root = self.local_path()
+        root.mkdir(parents=True, exist_ok=True)
+        remote = {entry.path: entry for entry in self._list_directory()}
+        # Remove local files and folders that no longer exist on the server, deepest
+        # first so folders are emptied before they are removed.
+        for path in sorted(root.rglob("*"), key=lambda p: len(p.parts), reverse=True):
+            entry = remote.get(path.relative_to(root).as_posix())
+            if path.is_dir() and (entry is None or not entry.is_folder):
+                shutil.rmtree(path)
+            elif not path.is_dir() and (entry is None or entry.is_folder):
+                path.unlink()
+
+        changed = [
+            entry
+            for entry in remote.values()
+            if not entry.is_folder and not entry.matches(root / entry.path)
+        ]
+        logger.info(f"Downloading {len(changed)} files from {self.query}")
+
+        def download(entry: RemoteEntry):
+            self.provider.throttle(self.query, Operation.RETRIEVE)
+            self._download_file(
+                f"{self.filepath}/{entry.path}", root / entry.path, entry.mtime
+            )
+
+        transfer_parallel(
+            download, changed, self.provider.settings.max_concurrent_transfers
+        )
+
+    def _store_directory(self):
+        root = self.local_path()
+        if self._folder_exists(self.filepath):
+            remote = {entry.path: entry for entry in self._list_directory()}
+            self.site.add_known_folder(self._folder_key(self.filepath))
+            for entry in remote.values():
+                if entry.is_folder:
+                    self.site.add_known_folder(
+                        self._folder_key(f"{self.filepath}/{entry.path}")
+                    )
+        else:
+            remote = {}
+
+        # The root folder is checked within the request of the managed store call,
+        # subfolders are created level by level on worker threads, which may wait for
+        # the rate limiter without blocking Snakemake.
+        self._ensure_folder(self.filepath)
+        levels: dict[int, list[str]] = {}
+        for path in root.rglob("*"):
+            if path.is_dir():
+                folder = path.relative_to(root).as_posix()
+                levels.setdefault(folder.count("/"), []).append(
+                    f"{self.filepath}/{folder}"
+                )
+        for _, folders in sorted(levels.items()):
+            transfer_parallel(
+                lambda folder: self._ensure_folder(folder, throttle=True),
+                folders,
+                self.provider.settings.max_concurrent_transfers,
+            )
+
+        changed = []
+        for path in root.rglob("*"):
+            if not path.is_file():
+                continue
+            entry = remote.get(path.relative_to(root).as_posix())
+            if entry is None or not entry.is_up_to_date_with(path):
+                changed.append(path)
+        logger.info(f"Uploading {len(changed)} files to {self.query}")
+
+        def upload(path: pathlib.Path):
+            self.provider.throttle(self.query, Operation.STORE)
+            mtime = self._upload_file(
+                path, f"{self.filepath}/{path.relative_to(root).as_posix()}"
+            )
+            # Match the server, so the next retrieval does not download the file again
+            if mtime is not None:
+                os.utime(path, (mtime, mtime))
+
+        transfer_parallel(
+            upload, changed, self.provider.settings.max_concurrent_transfers
+        )
+
+    def _add_folder(self, filename: str):
+        headers = {"x-requestdigest": self.site.form_digest()}
+        with self.httpr(
+            self.ADD_FOLDER_URL,
+            "POST",
+            headers=headers,
+            url_fields={"filename": filename},
+        ) as r:
+            try:
+                r.raise_for_status()
+            except requests.HTTPError as e:
+                raise WorkflowError(
+                    f"Failed to create folder {filename} in {self.library}\n"
+                    f"Response: {r.status_code} - {r.text}"
+                ) from e
 
     def remove(self):
         """Remove the file from the SharePoint server.
@@ -224,41 +761,44 @@ class StorageObject(StorageObjectRead, StorageObjectWrite):
         stream: bool = False,
         headers: dict[str, str] | None = None,
         data: Optional[Any] = None,
+        url_fields: Optional[dict[str, str]] = None,
         **kwargs: Any,
     ) -> Generator[requests.Response, Any, None]:
-        """Context manager for the connection to the server."""
+        """Context manager for the connection to the server.
+
+        The url is formatted with the site, library and file of this object, entries
+        in url_fields replace those for e.g. other files in the same folder.
+        """
         _headers = {
             "Content-Type": "application/json; odata=verbose",
             "Accept": "application/json; odata=verbose",
         }
-        _url = url.format(
-            site_url=self.site_url,
-            folder=self.library,
-            filename=self.filepath,
-            overwrite=str(self.allow_overwrite).lower(),
-        )
+        fields = {
+            "site_url": self.site_url,
+            "folder": self.library,
+            "filename": self.filepath,
+            "library_url": self.site.server_relative_url(self.library),
+            "overwrite": str(self.allow_overwrite).lower(),
+        }
+        if url_fields is not None:
+            fields.update(url_fields)
+        _url = url.format(**fields)
         logger.debug(f"Requesting HTTP {verb!r} {_url}")
         logger.debug(f"Authenticating with {self.provider.settings.auth}")
         if headers is not None:
             _headers.update(headers)
         r = None
         try:
-            match verb.upper():
-                case "GET":
-                    request = requests.get
-                case "POST":
-                    request = partial(requests.post, data=data)
-                case "HEAD":
-                    request = requests.head
-                case _:
-                    raise NotImplementedError(f"HTTP verb {verb} not implemented")
-
-            r = request(
+            if verb.upper() not in {"GET", "POST", "HEAD"}:
+                raise NotImplementedError(f"HTTP verb {verb} not implemented")
+
+            r = self.site.session.request(
+                verb.upper(),
                 _url,
+                data=data if verb.upper() == "POST" else None,
                 stream=stream,
-                auth=self.provider.settings.auth,
                 headers=_headers,
-                allow_redirects=self.provider.settings.allow_redirects or True,
+                allow_redirects=self.site.allow_redirects,
                 **kwargs,
             )
             logger.debug(f"Response: {r.status_code}")
@@ -289,3 +829,20 @@ class FileInfo:
         if not self.exists():
             return 0
         return int(self.response.json()["d"]["Length"])
+
+    def etag(self) -> Optional[str]:
+        if not self.exists():
+            return None
+        return normalize_etag(self.response.headers.get("ETag"))
+
+
+def normalize_etag(etag: Optional[str]) -> Optional[str]:
+    """Strip the weak validator prefix and quotes from an ETag header."""
+    if etag is None:
+        return None
+    return etag.removeprefix("W/").strip('"')
+
+
+class FolderInfo(FileInfo):
+    def exists(self) -> bool:
+        return super().exists() and self.response.json()["d"].get("Exists", True)
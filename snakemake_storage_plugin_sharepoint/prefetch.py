@@ -0,0 +1,184 @@
+"""Background downloads of inputs before the jobs that need them start."""
+
+import concurrent.futures
+import os
+import pathlib
+import queue
+import shutil
+import socket
+import tempfile
+import threading
+from typing import Any, Callable, Optional
+
+from snakemake_interface_common.logging import get_logger
+
+__all__ = ["Prefetcher", "make_staging_dir", "remove_stale_staging_dirs"]
+
+logger = get_logger()
+
+Download = Callable[[pathlib.Path], Any]
+
+
+def make_staging_dir(root: pathlib.Path) -> pathlib.Path:
+    """Create a new staging directory below the root.
+
+    Every prefetcher gets its own directory, as the local storage may be shared with
+    other processes, e.g. cluster jobs on a shared filesystem. The name of the
+    directory identifies the host and process, so stale directories can be found.
+    """
+    root.mkdir(parents=True, exist_ok=True)
+    prefix = f"{socket.gethostname()}-{os.getpid()}-"
+    return pathlib.Path(tempfile.mkdtemp(prefix=prefix, dir=root))
+
+
+def remove_stale_staging_dirs(root: pathlib.Path):
+    """Remove the staging directories of processes on this host that have ended."""
+    if not root.is_dir():
+        return
+    host = socket.gethostname()
+    for path in root.iterdir():
+        parts = path.name.rsplit("-", 2)
+        if len(parts) != 3 or parts[0] != host or not parts[1].isdigit():
+            continue
+        if _is_running(int(parts[1])):
+            continue
+        logger.debug(f"Removing stale prefetch staging directory {path}")
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _is_running(pid: int) -> bool:
+    if os.name == "nt":
+        # os.kill terminates the process on Windows, assume it is still running
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to another user
+        return True
+    return True
+
+
+class Prefetcher:
+    """Download files in the background, in the order they were scheduled.
+
+    Files are downloaded into a staging directory by a fixed number of daemon threads,
+    so the downloads never keep the process alive. The total size of the files that
+    are scheduled or downloaded but not yet taken is kept within the disk budget.
+    Files that turn out not to be needed must be discarded, and `close` removes all
+    files that were never taken.
+    """
+
+    def __init__(
+        self,
+        staging_dir: pathlib.Path,
+        max_workers: int,
+        disk_budget: Optional[int] = None,
+    ):
+        """Initialize the prefetcher and start its worker threads."""
+        self.staging_dir = staging_dir
+        self.disk_budget = disk_budget
+        self._queue: queue.Queue[
+            tuple[pathlib.Path, Download, concurrent.futures.Future]
+        ] = queue.Queue()
+        self._futures: dict[str, tuple[concurrent.futures.Future, int]] = {}
+        self._reserved = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        for i in range(max_workers):
+            threading.Thread(
+                target=self._work, name=f"mssp-prefetch-{i}", daemon=True
+            ).start()
+
+    def schedule(self, name: str, size: int, download: Download) -> bool:
+        """Schedule the download of a file unless it exceeds the disk budget.
+
+        The download function is called with the path in the staging directory to
+        download the file to.
+        """
+        with self._lock:
+            if self._closed:
+                return False
+            if name in self._futures:
+                return True
+            if (
+                self.disk_budget is not None
+                and self._reserved + size > self.disk_budget
+            ):
+                logger.debug(f"Not prefetching {name}, disk budget exhausted")
+                return False
+            future: concurrent.futures.Future = concurrent.futures.Future()
+            self._futures[name] = (future, size)
+            self._reserved += size
+        self._queue.put((self.staging_dir / name, download, future))
+        return True
+
+    def take(self, name: str) -> Optional[tuple[pathlib.Path, Any]]:
+        """Return the staged file, waiting for the download if it is in flight.
+
+        Returns the path of the staged file with the return value of the download
+        function, or None if the file was not scheduled, the download had not started
+        yet or failed. The caller owns the returned file and should move it out of the
+        staging directory.
+        """
+        with self._lock:
+            if name not in self._futures:
+                return None
+            future, _ = self._futures[name]
+        if future.cancel():
+            # Still queued behind other downloads, downloading directly is faster
+            self._release(name)
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            logger.debug(f"Prefetching {name} failed: {e}")
+            return None
+        finally:
+            self._release(name)
+
+    def discard(self, name: str):
+        """Drop the file if it was scheduled, deleting it once it is downloaded."""
+        with self._lock:
+            if name not in self._futures:
+                return
+            future, _ = self._futures[name]
+        future.cancel()
+        future.add_done_callback(_remove_result)
+        self._release(name)
+
+    def close(self):
+        """Stop prefetching and remove all files that were not taken."""
+        with self._lock:
+            self._closed = True
+            names = list(self._futures)
+        for name in names:
+            self.discard(name)
+        shutil.rmtree(self.staging_dir, ignore_errors=True)
+
+    def _release(self, name: str):
+        with self._lock:
+            if (entry := self._futures.pop(name, None)) is not None:
+                self._reserved -= entry[1]
+
+    def _work(self):
+        while True:
+            path, download, future = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                result = download(path)
+            except BaseException as e:
+                path.unlink(missing_ok=True)
+                future.set_exception(e)
+            else:
+                future.set_result((path, result))
+
+
+def _remove_result(future: concurrent.futures.Future):
+    if future.cancelled() or future.exception() is not None:
+        return
+    path, _ = future.result()
+    path.unlink(missing_ok=True)
@@ -1,8 +1,15 @@
 """Implementation of the storage provider protocol."""
 
+import atexit
+import dataclasses
+import filecmp
+import os
+import pathlib
+import threading
 import urllib.parse as urlparse
-from typing import TYPE_CHECKING, Any, Iterable, List
+from typing import TYPE_CHECKING, Any, Iterable, List, Optional
 
+from snakemake_interface_common.exceptions import WorkflowError
 from snakemake_interface_common.logging import get_logger
 from snakemake_interface_storage_plugins.common import Operation
 from snakemake_interface_storage_plugins.storage_provider import (
@@ -13,12 +20,43 @@ from snakemake_interface_storage_plugins.storage_provider import (
 )
 
 from .object import StorageObject
-from .settings import StorageProviderSettings
+from .prefetch import Prefetcher, make_staging_dir, remove_stale_staging_dirs
+from .ratelimit import LocalRateLimiter, RateLimiter, SharedRateLimiter
+from .settings import SITE_ALIAS_REGEX, StorageProviderSettings
+from .site import SharePointSite
+from .version import VersionCache, VersionSelector
 
 __all__ = ["StorageProvider", "StorageObject"]
 logger = get_logger()
 
 
+@dataclasses.dataclass(frozen=True)
+class _RetrievedFile:
+    obj: StorageObject
+    size: int
+    mtime_ns: int
+    inode: tuple[int, int]
+
+    @classmethod
+    def from_object(cls, obj: StorageObject) -> "_RetrievedFile":
+        stat = obj.local_path().stat()
+        return cls(obj, stat.st_size, stat.st_mtime_ns, (stat.st_dev, stat.st_ino))
+
+    def is_same_file(self, stat: os.stat_result) -> bool:
+        """Determine whether the file is the retrieved file, e.g. renamed or linked."""
+        return (
+            (stat.st_dev, stat.st_ino) == self.inode
+            and stat.st_size == self.size
+            and stat.st_mtime_ns == self.mtime_ns
+        )
+
+    def is_unchanged(self) -> bool:
+        try:
+            return self.is_same_file(self.obj.local_path().stat())
+        except FileNotFoundError:
+            return False
+
+
 class StorageProvider(StorageProviderBase):
     """Implementation of the storage provider protocol."""
 
@@ -30,16 +68,198 @@ class StorageProvider(StorageProviderBase):
         super().__post_init__()
         if self.settings.site_url is not None:
             self.settings.site_url = self.settings.site_url.rstrip("/")
+        self._sites: dict[Optional[str], SharePointSite] = {}
+        self._sites_lock = threading.Lock()
+        self._rate_limiters_lock = threading.Lock()
+        self._retrieved: dict[str, _RetrievedFile] = {}
+        self._retrieved_lock = threading.Lock()
+        self._prefetcher: Optional[Prefetcher] = None
+        self._prefetcher_lock = threading.Lock()
+        self._prefetch_sizes: dict[str, int] = {}
+        if self.settings.prefetch:
+            remove_stale_staging_dirs(self.local_prefix / ".prefetch")
+        self.version_cache = VersionCache(self.local_prefix / ".versions")
+
+    def site_url(self, alias: Optional[str] = None) -> str:
+        """Return the URL of the site registered under the alias.
+
+        Without an alias the URL from the `site_url` setting is returned.
+        """
+        if alias is None:
+            if self.settings.site_url is None:
+                raise WorkflowError("No site URL specified")
+            return self.settings.site_url
+        sites = self.settings.sites or {}
+        if alias not in sites:
+            raise WorkflowError(
+                f"Unknown site alias {alias!r}, register it with the sites setting"
+            )
+        return sites[alias].rstrip("/")
+
+    def site(self, alias: Optional[str] = None) -> SharePointSite:
+        """Return the connection state for the site registered under the alias."""
+        with self._sites_lock:
+            if alias not in self._sites:
+                self._sites[alias] = SharePointSite(
+                    self.site_url(alias),
+                    auth=self.settings.auth,
+                    allow_redirects=self.settings.allow_redirects or True,
+                    pool_maxsize=self.settings.max_concurrent_transfers,
+                )
+            return self._sites[alias]
+
+    def copy(self, source_query: str, target_query: str, move: bool = False):
+        """Copy or move a file to another location on the same site.
+
+        The copy is made by the SharePoint server, so the contents never pass through
+        this machine. Overwriting the target follows the same rules as for uploads.
+        """
+        source = self.object(source_query)
+        target = self.object(target_query)
+        target.copy_from(source, move=move)
+
+    def register_retrieved(self, obj: StorageObject):
+        """Remember a file that was just retrieved, for server-side copies.
+
+        Files without an ETag cannot be verified against the server before copying,
+        so they are not remembered.
+        """
+        if obj.retrieved_etag is None:
+            return
+        retrieved = _RetrievedFile.from_object(obj)
+        with self._retrieved_lock:
+            self._retrieved[str(obj.local_path())] = retrieved
+
+    def find_retrieved(
+        self, local_path: pathlib.Path, site: Optional[SharePointSite] = None
+    ) -> Optional[StorageObject]:
+        """Find a retrieved file with the same contents as the local file.
+
+        A retrieved file that was renamed or linked to the local path matches
+        directly, otherwise the contents are compared with retrieved files that were
+        not modified locally since their retrieval. If a site is given, only files
+        retrieved from that site are considered.
+        """
+        try:
+            stat = local_path.stat()
+        except FileNotFoundError:
+            return None
+        with self._retrieved_lock:
+            candidates = [
+                retrieved
+                for retrieved in self._retrieved.values()
+                if retrieved.size == stat.st_size
+                and (site is None or retrieved.obj.site is site)
+                and retrieved.obj.local_path() != local_path
+            ]
+        for retrieved in candidates:
+            if retrieved.is_same_file(stat):
+                return retrieved.obj
+        for retrieved in candidates:
+            if retrieved.is_unchanged() and filecmp.cmp(
+                retrieved.obj.local_path(), local_path, shallow=False
+            ):
+                return retrieved.obj
+        return None
+
+    def add_prefetch_candidate(self, obj: StorageObject, size: int):
+        """Remember an input found by the inventory, to prefetch once it is retrieved.
+
+        Snakemake inventories the inputs of all jobs in the DAG, including jobs that
+        will not run, so candidates are only prefetched when they are retrieved.
+        """
+        if not self.settings.prefetch:
+            return
+        with self._prefetcher_lock:
+            self._prefetch_sizes[obj.local_suffix()] = size
+
+    def prefetch_candidate(self, obj: StorageObject):
+        """Start prefetching the input if the inventory found it."""
+        with self._prefetcher_lock:
+            size = self._prefetch_sizes.pop(obj.local_suffix(), None)
+        if size is not None:
+            self.prefetch(obj, size)
+
+    def prefetch(self, obj: StorageObject, size: int):
+        """Start downloading the file in the background if prefetching is enabled.
+
+        Files are downloaded in the order they are scheduled.
+        """
+        if not self.settings.prefetch:
+            return
+        with self._prefetcher_lock:
+            if self._prefetcher is None:
+                budget = self.settings.prefetch_disk_budget
+                self._prefetcher = Prefetcher(
+                    make_staging_dir(self.local_prefix / ".prefetch"),
+                    max_workers=self.settings.prefetch_max_concurrent,
+                    disk_budget=budget * 1024 * 1024 if budget is not None else None,
+                )
+                # Files that were never taken must not remain after the run
+                atexit.register(self._prefetcher.close)
+
+        def download(path: pathlib.Path) -> Optional[str]:
+            # Prefetches run outside the managed_* methods, so throttle them here
+            self.throttle(obj.query, Operation.RETRIEVE)
+            return obj._download_content(path)
+
+        self._prefetcher.schedule(obj.local_suffix(), size, download)
+
+    def take_prefetched(
+        self, obj: StorageObject
+    ) -> Optional[tuple[pathlib.Path, Optional[str]]]:
+        """Return the prefetched copy of the file and its ETag, waiting if needed."""
+        if self._prefetcher is None:
+            return None
+        return self._prefetcher.take(obj.local_suffix())
+
+    def discard_prefetched(self, obj: StorageObject):
+        """Drop the prefetched copy of the file, e.g. because it is not needed."""
+        if self._prefetcher is not None:
+            self._prefetcher.discard(obj.local_suffix())
 
     def rate_limiter_key(self, query: str, operation: Operation) -> Any:
         """Return a key for identifying a rate limiter given a query and an operation.
 
-        This is used to identify a rate limiter for the query.
-        E.g. for a storage provider like http that would be the host name.
-        For s3 it might be just the endpoint URL.
+        Every site gets its own rate limiter, so a throttled site does not hold back
+        requests to the other sites.
         """
-        parsed = urlparse.urlparse(self.settings.site_url)
-        return parsed.netloc
+        return self.site_url(StorageObject.parse_query(query).site)
+
+    def rate_limiter(self, query: str, operation: Operation):
+        """Return the rate limiter for the query.
+
+        With the shared_rate_limit_db setting the rate limiter is shared by all
+        processes using the same database, e.g. all jobs of a cluster run.
+        """
+        if not self.use_rate_limiter():
+            return super().rate_limiter(query, operation)
+        key = self.rate_limiter_key(query, operation)
+        rate = (
+            self.settings.max_requests_per_second
+            or self.default_max_requests_per_second()
+        )
+        with self._rate_limiters_lock:
+            if key not in self._rate_limiters:
+                if self.settings.shared_rate_limit_db is None:
+                    limiter: RateLimiter = LocalRateLimiter(rate)
+                else:
+                    limiter = SharedRateLimiter(
+                        self.settings.shared_rate_limit_db, key, rate
+                    )
+                self._rate_limiters[key] = limiter
+            return self._rate_limiters[key]
+
+    def throttle(self, query: str, operation: Operation):
+        """Block until the rate limiter of the query allows another request.
+
+        This is meant for requests made from worker threads, which cannot use the
+        async rate limiting of the managed_* methods of the storage object. It must not
+        be called from the thread running the event loop of Snakemake, as waiting for
+        a shared rate limiter may take many seconds.
+        """
+        if self.use_rate_limiter():
+            self.rate_limiter(query, operation).acquire()
 
     @classmethod
     def example_queries(cls) -> List[ExampleQuery]:
@@ -77,6 +297,39 @@ class StorageProvider(StorageProviderBase):
                 ),
                 type=QueryType.OUTPUT,
             ),
+            ExampleQuery(
+                query="mssp://library/folder/",
+                description=(
+                    "The folder `folder` with all files and subfolders in a "
+                    "SharePoint library called `library`, for use with `directory()`."
+                ),
+                type=QueryType.ANY,
+            ),
+            ExampleQuery(
+                query="mssp://Documents/data.csv?version=3.0",
+                description=(
+                    "Version 3.0 of the file `data.csv` in a SharePoint library called "
+                    "`Documents`. Pinned versions are cached and never revalidated."
+                ),
+                type=QueryType.INPUT,
+            ),
+            ExampleQuery(
+                query="mssp://Documents/data.csv?version=2024-05-01T12:00:00Z",
+                description=(
+                    "The version of the file `data.csv` in a SharePoint library called "
+                    "`Documents` that was current on 1 May 2024 at 12:00 UTC."
+                ),
+                type=QueryType.INPUT,
+            ),
+            ExampleQuery(
+                query="mssp://Documents/data.csv?site=archive",
+                description=(
+                    "A file `data.csv` in a SharePoint library called `Documents` on "
+                    "the site registered under the alias `archive` in the `sites` "
+                    "setting."
+                ),
+                type=QueryType.ANY,
+            ),
         ]
 
     def default_max_requests_per_second(self) -> float:
@@ -130,6 +383,14 @@ class StorageProvider(StorageProviderBase):
             logger.debug(f"querystring validation result: {result!r}")
             if result is not None:
                 return result
+            if filepath.endswith("/") and "version" in urlparse.parse_qs(
+                querystring, keep_blank_values=True
+            ):
+                return StorageQueryValidationResult(
+                    query=query,
+                    valid=False,
+                    reason="version cannot be specified for folders",
+                )
         if fragment:
             return StorageQueryValidationResult(
                 query=query,
@@ -147,7 +408,7 @@ class StorageProvider(StorageProviderBase):
     ) -> StorageQueryValidationResult | None:
         query_params = urlparse.parse_qs(querystring, keep_blank_values=True)
         logger.debug(f"query parameters: {query_params!r}")
-        valid_keys = {"overwrite"}
+        valid_keys = {"overwrite", "site", "version"}
         invalid_keys = set(query_params.keys()) - valid_keys
         logger.debug(f"invalid keys: {invalid_keys!r}")
         if invalid_keys:
@@ -171,6 +432,22 @@ class StorageProvider(StorageProviderBase):
                     valid=False,
                     reason="overwrite must be 'true', 'false', 'none', or empty",
                 )
+        if "version" in query_params:
+            try:
+                VersionSelector.parse(query_params["version"][0])
+            except ValueError as e:
+                return StorageQueryValidationResult(
+                    query=query,
+                    valid=False,
+                    reason=str(e),
+                )
+        if "site" in query_params:
+            if not SITE_ALIAS_REGEX.match(query_params["site"][0]):
+                return StorageQueryValidationResult(
+                    query=query,
+                    valid=False,
+                    reason="site must be the alias of a site in the sites setting",
+                )
         return
 
     def list_objects(self, query: Any) -> Iterable[str]:
@@ -0,0 +1,202 @@
+"""Token bucket rate limiters, for use from async code as well as worker threads."""
+
+import asyncio
+import os
+import pathlib
+import socket
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+__all__ = ["RateLimiter", "LocalRateLimiter", "SharedRateLimiter"]
+
+
+class RateLimiter:
+    """Base class of the rate limiters.
+
+    Besides the async context manager used by Snakemake, `acquire` blocks the calling
+    thread, for requests made from worker threads such as parallel transfers.
+    """
+
+    def try_acquire(self) -> float:
+        """Take a token if available, otherwise return the seconds to wait."""
+        raise NotImplementedError()
+
+    def acquire(self):
+        """Block until a token is available."""
+        while (wait := self.try_acquire()) > 0:
+            time.sleep(wait)
+
+    async def __aenter__(self):
+        """Wait until a token is available."""
+        while (wait := self.try_acquire()) > 0:
+            await asyncio.sleep(wait)
+
+    async def __aexit__(self, *exc_info: Any):
+        """Release nothing, tokens are refilled over time."""
+        pass
+
+
+class LocalRateLimiter(RateLimiter):
+    """Thread-safe token bucket limiting the requests of this process."""
+
+    def __init__(self, rate: float):
+        """Initialize the rate limiter for the given requests per second."""
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        # Allow bursts of at most one second worth of requests
+        self.capacity = max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> float:
+        """Take a token if available, otherwise return the seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+
+class SharedRateLimiter(RateLimiter):
+    """Rate limiter that shares one request budget between all processes.
+
+    The state of the token bucket lives in an SQLite database, e.g. on a filesystem
+    shared by all cluster jobs, so all jobs together stay within the budget. Besides
+    the global bucket every process has its own bucket refilled at an equal share of
+    the budget among the processes that requested tokens recently. This way a busy
+    process cannot starve the others, while a process that has the bucket for itself
+    can still use the full budget.
+
+    A process that did not request a token for a few refill periods of its share is
+    considered idle and loses its share, while a process waiting for its next token
+    stays active. New processes start with an empty bucket, so a process cannot gain
+    a burst by joining or rejoining.
+
+    Timestamps come from the clocks of the hosts, which must be synchronized, e.g.
+    with NTP. A host with a lagging clock refills its buckets more slowly and may be
+    considered idle by the others.
+    """
+
+    # Processes that did not request a token for this many refill periods of their
+    # share, plus the margin in seconds, no longer get a share.
+    ACTIVE_PERIODS = 2.0
+    ACTIVE_MARGIN = 1.0
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS buckets (
+            key TEXT NOT NULL,
+            worker TEXT NOT NULL,
+            tokens REAL NOT NULL,
+            updated REAL NOT NULL,
+            PRIMARY KEY (key, worker)
+        )
+    """
+    # Row holding the global bucket for a key
+    GLOBAL = ""
+
+    def __init__(self, database: pathlib.Path, key: Any, rate: float):
+        """Initialize the rate limiter for the given key and requests per second."""
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.database = database
+        self.key = str(key)
+        self.rate = rate
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        # Every thread reuses its own connection, sqlite3 connections cannot be
+        # shared between threads
+        self._local = threading.local()
+        self.database.parent.mkdir(parents=True, exist_ok=True)
+        self._connection().execute(self.SCHEMA)
+
+    async def __aenter__(self):
+        """Wait until a token is available in the shared bucket."""
+        # The database may be locked by other processes, don't block the event loop
+        while (wait := await asyncio.to_thread(self.try_acquire)) > 0:
+            await asyncio.sleep(wait)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn: Optional[sqlite3.Connection] = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.database, timeout=60, isolation_level=None)
+            self._local.conn = conn
+        return conn
+
+    def try_acquire(self) -> float:
+        """Take a token if available, otherwise return the seconds to wait."""
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            wait = self._acquire(conn, time.time())
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+    def _acquire(self, conn: sqlite3.Connection, now: float) -> float:
+        buckets: dict[str, tuple[float, float]] = {
+            worker: (tokens, updated)
+            for worker, tokens, updated in conn.execute(
+                "SELECT worker, tokens, updated FROM buckets WHERE key = ?",
+                (self.key,),
+            )
+        }
+        others = [
+            worker for worker in buckets if worker not in (self.GLOBAL, self.worker)
+        ]
+        # The smallest share any process may have been waiting for, as the processes
+        # that are idle now were still counted when it was computed
+        lowest_share = self.rate / (len(others) + 1)
+        cutoff = now - self.ACTIVE_PERIODS / lowest_share - self.ACTIVE_MARGIN
+        idle = [worker for worker in others if buckets[worker][1] < cutoff]
+        if idle:
+            conn.executemany(
+                "DELETE FROM buckets WHERE key = ? AND worker = ?",
+                [(self.key, worker) for worker in idle],
+            )
+        share = self.rate / (len(others) - len(idle) + 1)
+
+        global_tokens = self._refill(
+            buckets.get(self.GLOBAL), self.rate, now, initial=None
+        )
+        worker_tokens = self._refill(buckets.get(self.worker), share, now, initial=0.0)
+        if global_tokens >= 1 and worker_tokens >= 1:
+            global_tokens -= 1
+            worker_tokens -= 1
+            wait = 0.0
+        else:
+            wait = max(
+                (1 - global_tokens) / self.rate,
+                (1 - worker_tokens) / share,
+            )
+        conn.executemany(
+            "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+            [
+                (self.key, self.GLOBAL, global_tokens, now),
+                (self.key, self.worker, worker_tokens, now),
+            ],
+        )
+        return wait
+
+    @staticmethod
+    def _refill(
+        bucket: Optional[tuple[float, float]],
+        rate: float,
+        now: float,
+        initial: Optional[float],
+    ) -> float:
+        # Allow bursts of at most one second worth of requests
+        capacity = max(rate, 1.0)
+        if bucket is None:
+            # Missing buckets start full unless an initial level is given
+            return capacity if initial is None else initial
+        tokens, updated = bucket
+        return min(capacity, tokens + max(now - updated, 0.0) * rate)
@@ -2,8 +2,9 @@
 
 import dataclasses
 import importlib
+import pathlib
 import re
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 import requests
 import requests.auth
@@ -16,6 +17,8 @@ AUTH_METAVAR = "[PACKAGE.]AUTH_TYPE[=ARG1,ARG2,...]"
 AUTH_REGEX = re.compile(
     r"^((?P<package>[\w\.]+)\.)?(?P<type>\w+)(=(?P<arg>(\w+,?)+))?$"
 )
+SITES_METAVAR = "ALIAS=SITE_URL[,ALIAS=SITE_URL,...]"
+SITE_ALIAS_REGEX = re.compile(r"^\w[\w\-]*$")
 
 
 class _PredefinedHTTPAuth:
@@ -76,6 +79,29 @@ def unparse_auth(auth: requests.auth.AuthBase) -> str:
     return f"{auth.__class__.__module__}.{auth.__class__.__name__}"
 
 
+def parse_sites(arg: Optional[str]) -> Optional[Dict[str, str]]:
+    """Parse the site aliases from the command line."""
+    if arg is None:
+        return None
+
+    sites: Dict[str, str] = {}
+    for item in _split(arg, ","):
+        alias, sep, url = item.partition("=")
+        alias = alias.strip()
+        url = url.strip().rstrip("/")
+        if not sep or not url or not SITE_ALIAS_REGEX.match(alias):
+            raise WorkflowError(f"Sites require a string of the form {SITES_METAVAR}")
+        if alias in sites:
+            raise WorkflowError(f"Site alias {alias} is specified more than once.")
+        sites[alias] = url
+    return sites
+
+
+def unparse_sites(sites: Dict[str, str]) -> str:
+    """Write the site aliases to a string."""
+    return ",".join(f"{alias}={url}" for alias, url in sites.items())
+
+
 # Define settings for your storage plugin (e.g. host url, credentials).
 # They will occur in the Snakemake CLI as --storage-<storage-plugin-name>-<param-name>
 # Make sure that all defined fields are 'Optional' and specify a default value
@@ -118,6 +144,20 @@ class StorageProviderSettings(StorageProviderSettingsBase):
             "env_var": True,
         },
     )
+    sites: Optional[Dict[str, str]] = dataclasses.field(
+        default=None,
+        metadata={
+            "help": (
+                "Additional SharePoint sites that can be addressed from a query with "
+                "?site=ALIAS. Each site gets its own connection pool, form digest and "
+                "rate limiter."
+            ),
+            "metavar": SITES_METAVAR,
+            "parse_func": parse_sites,
+            "unparse_func": unparse_sites,
+            "env_var": True,
+        },
+    )
     allow_overwrite: Optional[bool] = dataclasses.field(
         default=None,
         metadata={
@@ -130,3 +170,61 @@ class StorageProviderSettings(StorageProviderSettingsBase):
             "help": "The timeout in milliseconds for uploading files.",
         },
     )
+    shared_rate_limit_db: Optional[pathlib.Path] = dataclasses.field(
+        default=None,
+        metadata={
+            "help": (
+                "Path to an SQLite database on a filesystem shared by all jobs. If "
+                "given, max_requests_per_second is a budget shared by all jobs using "
+                "the database instead of a limit per job."
+            ),
+        },
+    )
+    prefetch: Optional[bool] = dataclasses.field(
+        default=False,
+        metadata={
+            "help": (
+                "Download the inputs of the jobs that will run in the background, "
+                "in parallel instead of one after another."
+            ),
+        },
+    )
+    prefetch_max_concurrent: int = dataclasses.field(
+        default=2,
+        metadata={
+            "help": "The maximum number of files prefetched in parallel.",
+        },
+    )
+    prefetch_disk_budget: Optional[int] = dataclasses.field(
+        default=None,
+        metadata={
+            "help": (
+                "The maximum size in megabytes of prefetched files waiting for their "
+                "job. Unlimited if not specified."
+            ),
+        },
+    )
+    server_side_copy: Optional[bool] = dataclasses.field(
+        default=True,
+        metadata={
+            "help": (
+                "Let the server copy outputs that are unchanged copies of retrieved "
+                "inputs on the same site, instead of uploading them."
+            ),
+        },
+    )
+    max_concurrent_transfers: int = dataclasses.field(
+        default=8,
+        metadata={
+            "help": (
+                "The maximum number of files transferred in parallel for folder "
+                "queries, also the size of the connection pool per site."
+            ),
+        },
+    )
+
+    def __post_init__(self):
+        """Validate the settings that cannot be checked by their type."""
+        for name in ["max_concurrent_transfers", "prefetch_max_concurrent"]:
+            if getattr(self, name) < 1:
+                raise WorkflowError(f"The {name} setting must be at least 1.")
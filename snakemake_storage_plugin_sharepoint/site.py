@@ -0,0 +1,118 @@
+"""Connection state shared by all storage objects on a single SharePoint site."""
+
+import threading
+import time
+import urllib.parse as urlparse
+from typing import Optional
+
+import requests
+import requests.adapters
+import requests.auth
+from snakemake_interface_common.exceptions import WorkflowError
+from snakemake_interface_common.logging import get_logger
+
+__all__ = ["SharePointSite"]
+
+logger = get_logger()
+
+
+class SharePointSite:
+    """A SharePoint site collection with its own connection pool and form digest.
+
+    Every site gets a separate `requests.Session`, so connections to one site are
+    reused between requests without competing with the pool of another site.
+    """
+
+    DIGEST_URL = "{site_url}/_api/contextinfo"
+    # Refresh the form digest somewhat before SharePoint expires it.
+    DIGEST_MARGIN = 60.0
+
+    def __init__(
+        self,
+        url: str,
+        auth: Optional[requests.auth.AuthBase] = None,
+        allow_redirects: bool = True,
+        pool_maxsize: int = requests.adapters.DEFAULT_POOLSIZE,
+    ):
+        """Initialize the site and its connection pool."""
+        self.url = url.rstrip("/")
+        parsed = urlparse.urlparse(self.url)
+        self.netloc = parsed.netloc
+        self.path = parsed.path.strip("/")
+        self.allow_redirects = allow_redirects
+        self.session = requests.Session()
+        self.session.auth = auth
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._digest: Optional[str] = None
+        self._digest_expires = 0.0
+        self._digest_lock = threading.Lock()
+        self._known_folders: set[str] = set()
+        self._folder_locks: dict[str, threading.Lock] = {}
+        self._folders_lock = threading.Lock()
+
+    def local_prefix(self) -> str:
+        """Return the local path prefix for files on this site."""
+        return "/".join(part for part in [self.netloc, self.path] if part)
+
+    def server_relative_url(self, *parts: str) -> str:
+        """Return the server relative URL of a path on this site."""
+        return "/" + "/".join(part.strip("/") for part in [self.path, *parts] if part)
+
+    def is_known_folder(self, url: str) -> bool:
+        """Determine whether the folder is known to exist on this site."""
+        with self._folders_lock:
+            return url in self._known_folders
+
+    def add_known_folder(self, url: str):
+        """Remember that the folder exists on this site."""
+        with self._folders_lock:
+            self._known_folders.add(url)
+            # Known folders are never checked again, so their lock is not needed
+            self._folder_locks.pop(url, None)
+
+    def folder_lock(self, url: str) -> threading.Lock:
+        """Return the lock that guards checking and creating the unknown folder."""
+        with self._folders_lock:
+            return self._folder_locks.setdefault(url, threading.Lock())
+
+    def form_digest(self) -> str:
+        """Return a valid form digest value, requesting a new one if necessary."""
+        with self._digest_lock:
+            if self._digest is None or time.monotonic() >= self._digest_expires:
+                self._digest, timeout = self._request_form_digest()
+                self._digest_expires = time.monotonic() + max(
+                    timeout - self.DIGEST_MARGIN, 0.0
+                )
+            return self._digest
+
+    def invalidate_form_digest(self):
+        """Forget the cached form digest, e.g. after it was rejected."""
+        with self._digest_lock:
+            self._digest = None
+
+    def _request_form_digest(self) -> tuple[str, float]:
+        logger.debug(f"Getting form digest value for {self.url}")
+        r = self.session.post(
+            self.DIGEST_URL.format(site_url=self.url),
+            headers={
+                "Content-Type": "application/json; odata=verbose",
+                "Accept": "application/json; odata=verbose",
+            },
+            allow_redirects=self.allow_redirects,
+        )
+        try:
+            r.raise_for_status()
+            info = r.json()["d"]["GetContextWebInformation"]
+        except (requests.HTTPError, ValueError, KeyError) as e:
+            raise WorkflowError(
+                f"Failed to get form digest value for {self.url}"
+            ) from e
+        finally:
+            r.close()
+        return info["FormDigestValue"], float(info.get("FormDigestTimeoutSeconds", 0))
+
+    def close(self):
+        """Close all pooled connections."""
+        self.session.close()
@@ -0,0 +1,185 @@
+"""Selection and caching of specific versions of SharePoint files."""
+
+import dataclasses
+import datetime
+import json
+import os
+import pathlib
+import re
+import shutil
+import tempfile
+from typing import Any, Iterable, Optional
+
+__all__ = ["VersionSelector", "VersionInfo", "VersionCache"]
+
+VERSION_LABEL_REGEX = re.compile(r"^(?P<major>\d+)(\.(?P<minor>\d+))?$")
+# SharePoint version IDs encode the version label as major * 512 + minor.
+MINOR_VERSIONS = 512
+
+
+def _parse_timestamp(value: str) -> float:
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+@dataclasses.dataclass(frozen=True)
+class VersionSelector:
+    """A version label (e.g. 3.0) or the version that was current at a time."""
+
+    label: Optional[str] = None
+    at: Optional[datetime.datetime] = None
+
+    @classmethod
+    def parse(cls, value: str) -> "VersionSelector":
+        """Parse a version label or an ISO 8601 date(time), naive times are UTC."""
+        if matches := VERSION_LABEL_REGEX.match(value):
+            major = int(matches.group("major"))
+            minor = int(matches.group("minor") or 0)
+            if minor >= MINOR_VERSIONS:
+                raise ValueError(f"minor version must be below {MINOR_VERSIONS}")
+            return cls(label=f"{major}.{minor}")
+        try:
+            at = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(
+                "version must be a version label (e.g. 3.0) or an ISO 8601 date or "
+                "time (e.g. 2024-05-01T12:00:00Z)"
+            ) from None
+        if at.tzinfo is None:
+            at = at.replace(tzinfo=datetime.timezone.utc)
+        return cls(at=at.astimezone(datetime.timezone.utc))
+
+    def local_name(self) -> str:
+        """Return the name of the local folder for this version."""
+        if self.at is not None:
+            return "@" + self.at.strftime("%Y%m%dT%H%M%SZ")
+        return f"@{self.label}"
+
+    def resolve(
+        self, current: Optional["VersionInfo"], history: Iterable["VersionInfo"]
+    ) -> Optional["VersionInfo"]:
+        """Select the version among the current version and its history."""
+        candidates = list(history)
+        if current is not None:
+            candidates.append(current)
+        if self.label is not None:
+            return next((v for v in candidates if v.label == self.label), None)
+        assert self.at is not None
+        at = self.at.timestamp()
+        candidates = [version for version in candidates if version.mtime <= at]
+        return max(candidates, key=lambda version: version.mtime, default=None)
+
+    def is_final(self, now: datetime.datetime) -> bool:
+        """Determine whether the selected version can no longer change."""
+        return self.at is None or self.at <= now
+
+
+@dataclasses.dataclass(frozen=True)
+class VersionInfo:
+    """Metadata of a single version of a file."""
+
+    label: str
+    mtime: float
+    size: int
+    # Whether this was the current version of the file when the metadata was fetched,
+    # the current version is not part of the Versions collection
+    current: bool = dataclasses.field(default=False, compare=False)
+
+    @property
+    def id(self) -> int:
+        """Return the ID of the version in the Versions collection of the file."""
+        major, _, minor = self.label.partition(".")
+        return int(major) * MINOR_VERSIONS + int(minor or 0)
+
+    @classmethod
+    def from_file(cls, d: dict[str, Any]) -> "VersionInfo":
+        """Read the current version from the metadata of a file."""
+        return cls(
+            label=d["UIVersionLabel"],
+            mtime=_parse_timestamp(d["TimeLastModified"]),
+            size=int(d["Length"]),
+            current=True,
+        )
+
+    @classmethod
+    def from_version(cls, d: dict[str, Any]) -> "VersionInfo":
+        """Read a historical version from an entry of the Versions collection."""
+        return cls(
+            label=d["VersionLabel"],
+            mtime=_parse_timestamp(d["Created"]),
+            size=int(d["Size"]),
+        )
+
+
+class VersionCache:
+    """Metadata and contents of pinned versions, stored on disk between runs.
+
+    Versions are immutable, so cached entries never have to be revalidated. The
+    contents of a version are stored under the same name as its metadata, without the
+    .json suffix, and linked or copied to the local copy that jobs use, which
+    Snakemake may delete after the run.
+    """
+
+    def __init__(self, root: pathlib.Path):
+        """Initialize the cache in the given directory."""
+        self.root = root
+
+    def _path(self, name: str) -> pathlib.Path:
+        return self.root / f"{name}.json"
+
+    def get(self, name: str) -> Optional[VersionInfo]:
+        """Return the cached metadata, if any."""
+        try:
+            with self._path(name).open() as fh:
+                return VersionInfo(**json.load(fh))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def put(self, name: str, info: VersionInfo):
+        """Store the metadata, atomically replacing any existing entry."""
+        path = self._path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # A newer version may be published later, so the cached version cannot be
+        # assumed to be current
+        info = dataclasses.replace(info, current=False)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as fh:
+                json.dump(dataclasses.asdict(info), fh)
+            os.replace(tmp, path)
+        except BaseException:
+            pathlib.Path(tmp).unlink(missing_ok=True)
+            raise
+
+    def content_path(self, name: str) -> pathlib.Path:
+        """Return the path of the cached contents."""
+        return self.root / name
+
+    def has_content(self, name: str, info: VersionInfo) -> bool:
+        """Determine whether the complete contents of the version are cached."""
+        try:
+            return self.content_path(name).stat().st_size == info.size
+        except FileNotFoundError:
+            return False
+
+    def put_content(self, name: str, source: pathlib.Path):
+        """Move the downloaded contents into the cache, atomically replacing them."""
+        path = self.content_path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        os.close(fd)
+        try:
+            # Preserves the timestamp, also when moving between filesystems
+            shutil.move(source, tmp)
+            os.replace(tmp, path)
+        except BaseException:
+            pathlib.Path(tmp).unlink(missing_ok=True)
+            raise
+
+    def link_content(self, name: str, target: pathlib.Path):
+        """Hard link the cached contents to the target, or copy if that fails."""
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.unlink(missing_ok=True)
+        try:
+            os.link(self.content_path(name), target)
+        except OSError:
+            shutil.copy2(self.content_path(name), target)
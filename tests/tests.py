@@ -9,11 +9,24 @@ __copyright__ = "Copyright 2023, Christopher Tomkins-Tinch, Johannes Köster"
 __email__ = "johannes.koester@uni-due.de"
 __license__ = "MIT"
 
+import asyncio
+import collections
 import contextlib
+import filecmp
+import os
 import pathlib
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
 import tempfile
-from typing import Generator, List, Optional, Type
+import threading
+from typing import Dict, Generator, List, Optional, Type
 
+import pytest
+from snakemake_interface_common.exceptions import WorkflowError
+from snakemake_interface_storage_plugins.common import Operation
 from snakemake_interface_storage_plugins.settings import StorageProviderSettingsBase
 from snakemake_interface_storage_plugins.storage_provider import StorageProviderBase
 from snakemake_interface_storage_plugins.tests import TestStorageBase
@@ -22,6 +35,27 @@ from snakemake_storage_plugin_sharepoint import (
     StorageObject,
     StorageProvider,
     StorageProviderSettings,
+    ratelimit,
+)
+from snakemake_storage_plugin_sharepoint.folder import (
+    RemoteEntry,
+    parse_rows,
+    transfer_parallel,
+)
+from snakemake_storage_plugin_sharepoint.prefetch import (
+    Prefetcher,
+    make_staging_dir,
+    remove_stale_staging_dirs,
+)
+from snakemake_storage_plugin_sharepoint.ratelimit import (
+    LocalRateLimiter,
+    SharedRateLimiter,
+)
+from snakemake_storage_plugin_sharepoint.settings import parse_sites
+from snakemake_storage_plugin_sharepoint.version import (
+    VersionCache,
+    VersionInfo,
+    VersionSelector,
 )
 
 
@@ -120,14 +154,53 @@ class TestQueryValidation:
         """Test query with invalid option is invalid."""
         assert query_is_invalid("mssp://library/filename.txt?invalid=true")
 
+    def test_query_with_library_and_folder_is_valid(self):
+        """Test query with library and folder is valid."""
+        assert query_is_valid("mssp://library/folder/")
+
+    def test_query_with_version_label_is_valid(self):
+        """Test query with version label is valid."""
+        assert query_is_valid("mssp://library/filename.txt?version=3.0")
+
+    def test_query_with_version_time_is_valid(self):
+        """Test query with version time is valid."""
+        assert query_is_valid("mssp://library/filename.txt?version=2024-05-01")
+
+    def test_query_with_invalid_version_is_invalid(self):
+        """Test query with invalid version is invalid."""
+        assert query_is_invalid("mssp://library/filename.txt?version=latest")
+
+    def test_query_with_folder_and_version_is_invalid(self):
+        """Test query with folder and version is invalid."""
+        assert query_is_invalid("mssp://library/folder/?version=3.0")
+
+    def test_query_with_site_alias_is_valid(self):
+        """Test query with site alias is valid."""
+        assert query_is_valid("mssp://library/filename.txt?site=archive")
+
+    def test_query_with_site_and_overwrite_is_valid(self):
+        """Test query with site alias and overwrite is valid."""
+        assert query_is_valid("mssp://library/filename.txt?site=archive&overwrite")
+
+    def test_query_with_empty_site_is_invalid(self):
+        """Test query with empty site alias is invalid."""
+        assert query_is_invalid("mssp://library/filename.txt?site")
+
+    def test_query_with_site_url_is_invalid(self):
+        """Test query with a URL instead of a site alias is invalid."""
+        assert query_is_invalid("mssp://library/filename.txt?site=https://host/site")
+
 
 @contextlib.contextmanager
 def storage_provider(
     allow_overwrite: Optional[bool] = None,
+    sites: Optional[Dict[str, str]] = None,
 ) -> Generator[StorageProvider, None, None]:
     """Return a storage provider with settings."""
     settings = StorageProviderSettings(
-        site_url="https://snakemake.readthedocs.io", allow_overwrite=allow_overwrite
+        site_url="https://snakemake.readthedocs.io",
+        allow_overwrite=allow_overwrite,
+        sites=sites,
     )
     try:
         with tempfile.TemporaryDirectory() as tempdir:
@@ -184,3 +257,812 @@ class TestOverwriteState:
         """Test overwrite state setting false and file false is false."""
         with storage_provider(allow_overwrite=False) as provider:
             assert not StorageObject.get_overwrite_state(False, provider)
+
+
+class TestSites:
+    """Test the routing of queries to multiple sites."""
+
+    SITES = {
+        "archive": "https://archive.example.com/sites/archive",
+        "team": "https://snakemake.readthedocs.io/sites/team/",
+    }
+
+    def test_parse_sites(self):
+        """Test parsing site aliases from the command line."""
+        assert parse_sites("a=https://host/sites/a,b=https://other/") == {
+            "a": "https://host/sites/a",
+            "b": "https://other",
+        }
+
+    def test_parse_sites_without_url_raises(self):
+        """Test parsing a site alias without URL raises."""
+        with pytest.raises(WorkflowError):
+            parse_sites("a")
+
+    def test_parse_sites_with_duplicate_alias_raises(self):
+        """Test parsing a duplicate site alias raises."""
+        with pytest.raises(WorkflowError):
+            parse_sites("a=https://host,a=https://other")
+
+    def test_query_without_site_uses_site_url(self):
+        """Test query without site alias uses the site_url setting."""
+        with storage_provider(sites=self.SITES) as provider:
+            obj = provider.object("mssp://library/file.txt")
+            assert obj.site_url == "https://snakemake.readthedocs.io"
+
+    def test_query_with_site_uses_alias(self):
+        """Test query with site alias uses the registered site."""
+        with storage_provider(sites=self.SITES) as provider:
+            obj = provider.object("mssp://library/file.txt?site=team")
+            assert obj.site_url == "https://snakemake.readthedocs.io/sites/team"
+            assert obj.local_suffix() == (
+                "snakemake.readthedocs.io/sites/team/library/file.txt"
+            )
+
+    def test_query_with_unknown_site_raises(self):
+        """Test query with unregistered site alias raises."""
+        with storage_provider(sites=self.SITES) as provider:
+            with pytest.raises(WorkflowError):
+                provider.object("mssp://library/file.txt?site=unknown")
+
+    def test_objects_on_same_site_share_connection_state(self):
+        """Test objects on the same site share the connection pool."""
+        with storage_provider(sites=self.SITES) as provider:
+            a = provider.object("mssp://library/a.txt?site=archive")
+            b = provider.object("mssp://library/b.txt?site=archive")
+            c = provider.object("mssp://library/c.txt")
+            assert a.site is b.site
+            assert a.site is not c.site
+
+    def test_sites_have_separate_rate_limiters(self):
+        """Test each site gets its own rate limiter."""
+        with storage_provider(sites=self.SITES) as provider:
+            keys = {
+                provider.rate_limiter_key(query, Operation.EXISTS)
+                for query in [
+                    "mssp://library/a.txt",
+                    "mssp://library/b.txt?site=archive",
+                    "mssp://library/c.txt?site=team",
+                    "mssp://other/d.txt?site=team",
+                ]
+            }
+            assert len(keys) == 3
+
+
+class TestDirectories:
+    """Test the helpers for folder queries."""
+
+    def test_query_with_trailing_slash_is_directory(self):
+        """Test query with trailing slash is a directory."""
+        parsed = StorageObject.parse_query("mssp://library/folder/sub/")
+        assert parsed.is_directory
+        assert parsed.filepath == "folder/sub"
+
+    def test_query_without_trailing_slash_is_file(self):
+        """Test query without trailing slash is a file."""
+        assert not StorageObject.parse_query("mssp://library/folder/file").is_directory
+
+    def test_directory_local_suffix(self):
+        """Test the local suffix of a directory has no trailing slash."""
+        with storage_provider() as provider:
+            obj = provider.object("mssp://library/folder/")
+            assert obj.local_suffix() == "snakemake.readthedocs.io/library/folder"
+
+    def test_store_folder_without_trailing_slash_raises(self):
+        """Test a local folder cannot be stored with a file query."""
+        with storage_provider() as provider:
+            obj = provider.object("mssp://library/folder")
+            obj.local_path().mkdir(parents=True)
+            with pytest.raises(WorkflowError, match="trailing slash"):
+                obj.store_object()
+
+    def test_remote_entry_is_up_to_date_with(self, tmp_path):
+        """Test a remote file is up to date if it has the same size and is not older."""
+        path = tmp_path / "file.txt"
+        path.write_text("data")
+        os.utime(path, (100, 100))
+        assert RemoteEntry("file.txt", False, 4, 100).is_up_to_date_with(path)
+        assert RemoteEntry("file.txt", False, 4, 200).is_up_to_date_with(path)
+        assert not RemoteEntry("file.txt", False, 4, 50).is_up_to_date_with(path)
+        assert not RemoteEntry("file.txt", False, 5, 200).is_up_to_date_with(path)
+
+    def test_max_concurrent_transfers_must_be_positive(self):
+        """Test zero parallel transfers are rejected with the settings."""
+        with pytest.raises(WorkflowError):
+            StorageProviderSettings(max_concurrent_transfers=0)
+
+    def test_parse_rows(self):
+        """Test parsing a listing relative to the root folder."""
+        rows = [
+            {
+                "FileRef": "/sites/a/library/folder/sub",
+                "FSObjType": "1",
+                "Modified.": "2024-05-01T10:00:00Z",
+            },
+            {
+                "FileRef": "/sites/a/library/folder/sub/file.txt",
+                "FSObjType": "0",
+                "File_x0020_Size": "12",
+                "Modified.": "2024-05-01T10:00:00Z",
+            },
+        ]
+        entries = list(parse_rows(rows, "/sites/a/library/folder"))
+        assert [entry.path for entry in entries] == ["sub", "sub/file.txt"]
+        assert entries[0].is_folder
+        assert not entries[1].is_folder
+        assert entries[1].size == 12
+        assert entries[1].mtime == 1714557600
+
+    def test_remote_entry_matches_local_file(self, tmp_path):
+        """Test a local file with equal size and timestamp matches."""
+        path = tmp_path / "file.txt"
+        path.write_bytes(b"0123456789")
+        os.utime(path, (1714557600, 1714557600))
+        assert RemoteEntry("file.txt", False, 10, 1714557600).matches(path)
+        assert not RemoteEntry("file.txt", False, 11, 1714557600).matches(path)
+        assert not RemoteEntry("file.txt", False, 10, 1714557601).matches(path)
+        assert not RemoteEntry("other.txt", False, 10, 1714557600).matches(
+            tmp_path / "other.txt"
+        )
+
+    def test_transfer_parallel_propagates_errors(self):
+        """Test errors raised in a transfer are propagated."""
+
+        def transfer(item: int):
+            if item == 3:
+                raise WorkflowError("failed")
+
+        with pytest.raises(WorkflowError):
+            transfer_parallel(transfer, range(10), max_workers=4)
+
+    def test_retrieve_directory_removes_stale_files(self, monkeypatch):
+        """Test local files that are not on the server are removed."""
+        with storage_provider() as provider:
+            obj = provider.object("mssp://library/folder/")
+            root = obj.local_path()
+            (root / "old").mkdir(parents=True)
+            (root / "old" / "file.txt").write_bytes(b"old")
+            (root / "stale.txt").write_bytes(b"stale")
+            (root / "keep.txt").write_bytes(b"keep")
+            os.utime(root / "keep.txt", (1714557600, 1714557600))
+            downloaded: List[str] = []
+            monkeypatch.setattr(
+                obj,
+                "_list_directory",
+                lambda: [RemoteEntry("keep.txt", False, 4, 1714557600)],
+            )
+            monkeypatch.setattr(
+                obj, "_download_file", lambda f, *args: downloaded.append(f)
+            )
+            obj.retrieve_object()
+            assert sorted(p.name for p in root.iterdir()) == ["keep.txt"]
+            assert downloaded == []
+
+    def test_store_directory_matches_server_mtime(self, monkeypatch):
+        """Test uploaded files are not downloaded again on the next retrieval."""
+        with storage_provider() as provider:
+            obj = provider.object("mssp://library/folder/")
+            path = obj.local_path() / "file.txt"
+            path.parent.mkdir(parents=True)
+            path.write_bytes(b"contents")
+            monkeypatch.setattr(obj, "_folder_exists", lambda f: True)
+            monkeypatch.setattr(obj, "_list_directory", lambda: [])
+            monkeypatch.setattr(obj, "_ensure_folder", lambda f: None)
+            monkeypatch.setattr(obj, "_upload_file", lambda p, f: 1714557600.0)
+            obj.store_object()
+            assert RemoteEntry("file.txt", False, 8, 1714557600.0).matches(path)
+
+    def test_directory_transfers_are_throttled(self, monkeypatch):
+        """Test every file transfer takes a token of the rate limiter."""
+        with storage_provider() as provider:
+            obj = provider.object("mssp://library/folder/")
+            throttled: List[Operation] = []
+            entries = [RemoteEntry(f"{i}.txt", False, 1, 0) for i in range(3)]
+            monkeypatch.setattr(obj, "_list_directory", lambda: entries)
+            monkeypatch.setattr(obj, "_download_file", lambda *args: None)
+            monkeypatch.setattr(
+                provider, "throttle", lambda query, op: throttled.append(op)
+            )
+            obj.retrieve_object()
+            assert throttled == [Operation.RETRIEVE] * 3
+
+    def test_throttling_only_blocks_worker_threads(self, monkeypatch):
+        """Test the event loop thread never waits for the rate limiter."""
+        with storage_provider() as provider:
+            obj = provider.object("mssp://library/folder/")
+            (obj.local_path() / "sub").mkdir(parents=True)
+            (obj.local_path() / "sub/file.txt").write_text("contents")
+            throttled: List[Operation] = []
+
+            def throttle(query: str, operation: Operation):
+                assert threading.current_thread() is not threading.main_thread()
+                throttled.append(operation)
+
+            monkeypatch.setattr(provider, "throttle", throttle)
+            monkeypatch.setattr(obj, "_folder_exists", lambda filename: False)
+            monkeypatch.setattr(obj, "_add_folder", lambda filename: None)
+            monkeypatch.setattr(obj, "_upload_file", lambda *args: None)
+            obj.store_object()
+            assert collections.Counter(throttled) == {
+                Operation.EXISTS: 1,
+                Operation.STORE: 2,
+            }
+
+
+class TestFolderCache:
+    """Test the creation of missing parent folders."""
+
+    def test_parent_folders_are_created_once(self, monkeypatch):
+        """Test every missing folder is checked and created only once."""
+        with storage_provider() as provider:
+            checked: List[str] = []
+            created: List[str] = []
+            objects = [
+                provider.object(f"mssp://library/a/b/c/file{i}.txt") for i in range(20)
+            ]
+            for obj in objects:
+                monkeypatch.setattr(
+                    obj, "_folder_exists", lambda f: checked.append(f) or f == "a"
+                )
+                monkeypatch.setattr(obj, "_add_folder", created.append)
+            transfer_parallel(
+                lambda obj: obj._ensure_folder("a/b/c"), objects, max_workers=8
+            )
+            assert sorted(checked) == ["a", "a/b", "a/b/c"]
+            assert sorted(created) == ["a/b", "a/b/c"]
+
+    def test_existing_folder_is_checked_directly(self, monkeypatch):
+        """Test an existing folder is found with one request, including its parents."""
+        with storage_provider() as provider:
+            checked: List[str] = []
+            obj = provider.object("mssp://library/a/b/c/d/file.txt")
+            monkeypatch.setattr(
+                obj, "_folder_exists", lambda f: checked.append(f) or True
+            )
+            obj._ensure_folder("a/b/c/d")
+            obj._ensure_folder("a/b")
+            assert checked == ["a/b/c/d"]
+            assert not provider.site()._folder_locks
+
+    def test_folder_cache_is_per_site(self):
+        """Test a folder known on one site is unknown on another."""
+        sites = {"other": "https://other.example.com"}
+        with storage_provider(sites=sites) as provider:
+            provider.site().add_known_folder("/library/a")
+            assert provider.site().is_known_folder("/library/a")
+            assert not provider.site("other").is_known_folder("/library/a")
+
+
+class TestServerSideCopy:
+    """Test the detection of outputs that can be copied on the server."""
+
+    def retrieved(self, provider: StorageProvider, query: str) -> StorageObject:
+        """Return a storage object of which the local copy was just retrieved."""
+        obj = provider.object(query)
+        obj.local_path().parent.mkdir(parents=True, exist_ok=True)
+        obj.local_path().write_bytes(b"retrieved contents")
+        obj.retrieved_etag = "{00000000-0000-0000-0000-000000000000},1"
+        provider.register_retrieved(obj)
+        return obj
+
+    def store_copy(self, monkeypatch, remote_etag: str) -> List[str]:
+        """Store a copy of a retrieved file and return how it was transferred."""
+        transfers = []
+        monkeypatch.setattr(StorageObject, "remote_etag", lambda self: remote_etag)
+        monkeypatch.setattr(
+            StorageObject,
+            "copy_from",
+            lambda self, source, move=False: transfers.append("copy"),
+        )
+        monkeypatch.setattr(
+            StorageObject,
+            "_upload_file",
+            lambda self, local_path, filename: transfers.append("upload"),
+        )
+        with storage_provider() as provider:
+            source = self.retrieved(provider, "mssp://library/input.txt")
+            target = provider.object("mssp://library/output.txt")
+            shutil.copy(source.local_path(), target.local_path())
+            target.store_object()
+        return transfers
+
+    def test_copy_of_retrieved_file_is_found(self, tmp_path):
+        """Test an identical copy of a retrieved file is found."""
+        with storage_provider() as provider:
+            source = self.retrieved(provider, "mssp://library/input.txt")
+            output = tmp_path / "output.txt"
+            output.write_bytes(b"retrieved contents")
+            assert provider.find_retrieved(output) is source
+
+    def test_renamed_retrieved_file_is_found(self, tmp_path):
+        """Test a retrieved file that was moved to the output is found."""
+        with storage_provider() as provider:
+            source = self.retrieved(provider, "mssp://library/input.txt")
+            output = source.local_path().with_name("output.txt")
+            source.local_path().rename(output)
+            assert provider.find_retrieved(output) is source
+
+    def test_modified_copy_is_not_found(self, tmp_path):
+        """Test a file with different contents is not found."""
+        with storage_provider() as provider:
+            self.retrieved(provider, "mssp://library/input.txt")
+            output = tmp_path / "output.txt"
+            output.write_bytes(b"modified contents!")
+            assert provider.find_retrieved(output) is None
+
+    def test_copy_of_modified_retrieved_file_is_not_found(self, tmp_path):
+        """Test a copy of a retrieved file that was modified locally is not found."""
+        with storage_provider() as provider:
+            source = self.retrieved(provider, "mssp://library/input.txt")
+            source.local_path().write_bytes(b"modified contents!")
+            os.utime(source.local_path(), (0, 0))
+            output = tmp_path / "output.txt"
+            output.write_bytes(b"modified contents!")
+            assert provider.find_retrieved(output) is None
+
+    def test_unchanged_source_is_copied(self, monkeypatch):
+        """Test an output is copied on the server if the source is unchanged."""
+        etag = "{00000000-0000-0000-0000-000000000000},1"
+        assert self.store_copy(monkeypatch, etag) == ["copy"]
+
+    def test_changed_source_is_uploaded(self, monkeypatch):
+        """Test an output is uploaded if the source changed since its retrieval."""
+        etag = "{00000000-0000-0000-0000-000000000000},2"
+        assert self.store_copy(monkeypatch, etag) == ["upload"]
+
+    def test_source_verification_is_rate_limited(self, monkeypatch):
+        """Test verifying the source of a copy takes a token of its own."""
+        operations: List[Operation] = []
+
+        @contextlib.asynccontextmanager
+        async def rate_limiter(self, operation: Operation):
+            operations.append(operation)
+            yield
+
+        monkeypatch.setattr(StorageObject, "_rate_limiter", rate_limiter)
+        monkeypatch.setattr(StorageObject, "remote_etag", lambda self: None)
+        monkeypatch.setattr(StorageObject, "_upload_file", lambda self, *args: None)
+        with storage_provider() as provider:
+            source = self.retrieved(provider, "mssp://library/input.txt")
+            target = provider.object("mssp://library/output.txt")
+            shutil.copy(source.local_path(), target.local_path())
+            asyncio.run(target.managed_store())
+        assert operations == [Operation.EXISTS, Operation.STORE]
+
+    def test_files_from_other_sites_are_not_compared(self, monkeypatch, tmp_path):
+        """Test the contents are only compared with files from the same site."""
+        monkeypatch.setattr(filecmp, "cmp", None)
+        sites = {"other": "https://other.example.com"}
+        with storage_provider(sites=sites) as provider:
+            self.retrieved(provider, "mssp://library/input.txt")
+            output = tmp_path / "output.txt"
+            output.write_bytes(b"retrieved contents")
+            assert provider.find_retrieved(output, provider.site("other")) is None
+
+    def test_file_without_etag_is_not_registered(self, tmp_path):
+        """Test a retrieved file that cannot be verified is not remembered."""
+        with storage_provider() as provider:
+            source = self.retrieved(provider, "mssp://library/input.txt")
+            source.retrieved_etag = None
+            provider._retrieved.clear()
+            provider.register_retrieved(source)
+            output = tmp_path / "output.txt"
+            output.write_bytes(b"retrieved contents")
+            assert provider.find_retrieved(output) is None
+
+    def test_retrieved_version_is_not_copied(self, monkeypatch, tmp_path):
+        """Test a retrieved pinned version is not used as source of a copy."""
+
+        def download(filename, local_path, mtime=None, version_id=None) -> str:
+            local_path.write_bytes(b"v3")
+            return "{00000000-0000-0000-0000-000000000000},3"
+
+        info = VersionInfo("3.0", 300.0, 2)
+        monkeypatch.setattr(StorageObject, "_version_info", lambda self: info)
+        with storage_provider() as provider:
+            source = provider.object("mssp://library/input.txt?version=3.0")
+            monkeypatch.setattr(source, "_download_file", download)
+            source.retrieve_object()
+            output = tmp_path / "output.txt"
+            output.write_bytes(b"v3")
+            assert provider.find_retrieved(output) is None
+            with pytest.raises(WorkflowError):
+                provider.copy(
+                    "mssp://library/input.txt?version=3.0", "mssp://library/output.txt"
+                )
+
+    def test_copy_to_version_raises(self):
+        """Test a pinned version cannot be the target of a server-side copy."""
+        with storage_provider() as provider:
+            with pytest.raises(WorkflowError, match="read-only"):
+                provider.copy(
+                    "mssp://library/input.txt", "mssp://library/output.txt?version=3.0"
+                )
+
+    def test_copy_between_sites_raises(self):
+        """Test a server-side copy between different sites raises."""
+        sites = {"other": "https://other.example.com"}
+        with storage_provider(sites=sites) as provider:
+            with pytest.raises(WorkflowError):
+                provider.copy(
+                    "mssp://library/input.txt", "mssp://library/output.txt?site=other"
+                )
+
+
+class TestSharedRateLimiter:
+    """Test the rate limiter shared between processes."""
+
+    @pytest.fixture
+    def clock(self, monkeypatch) -> List[float]:
+        """Return a mutable clock used by the shared rate limiters."""
+        now = [1_000_000.0]
+        monkeypatch.setattr(ratelimit.time, "time", lambda: now[0])
+        return now
+
+    def test_budget_is_shared_between_workers(self, tmp_path, clock):
+        """Test all workers together stay within the budget, in equal shares."""
+        database = tmp_path / "ratelimit.sqlite"
+        workers = [SharedRateLimiter(database, "host", 4.0) for _ in range(2)]
+        workers[1].worker = "other"
+        granted = [0, 0]
+        for _ in range(200):
+            clock[0] += 0.05
+            for i, worker in enumerate(workers):
+                granted[i] += worker.try_acquire() == 0
+        assert sum(granted) <= 4 * 10 + 4
+        assert all(15 <= count <= 25 for count in granted)
+
+    def test_local_rate_limiter(self):
+        """Test the rate limiter of a single process allows one second of burst."""
+        limiter = LocalRateLimiter(4.0)
+        assert [limiter.try_acquire() == 0 for _ in range(5)] == [True] * 4 + [False]
+
+    def test_new_worker_starts_empty(self, tmp_path, clock):
+        """Test a worker cannot gain a burst by joining."""
+        limiter = SharedRateLimiter(tmp_path / "ratelimit.sqlite", "host", 4.0)
+        assert limiter.try_acquire() == pytest.approx(0.25)
+
+    def test_idle_budget_is_available_to_single_worker(self, tmp_path, clock):
+        """Test a single worker can use the full budget."""
+        limiter = SharedRateLimiter(tmp_path / "ratelimit.sqlite", "host", 4.0)
+        limiter.try_acquire()
+        clock[0] += 1.0
+        assert [limiter.try_acquire() == 0 for _ in range(5)] == [True] * 4 + [False]
+
+    def test_waiting_worker_keeps_share(self, tmp_path, clock):
+        """Test a worker waiting for its next token is not considered idle."""
+        database = tmp_path / "ratelimit.sqlite"
+        first = SharedRateLimiter(database, "host", 0.1)
+        second = SharedRateLimiter(database, "host", 0.1)
+        second.worker = "other"
+        first.try_acquire()
+        clock[0] += second.try_acquire() / 2
+        first.try_acquire()
+        with contextlib.closing(sqlite3.connect(database)) as conn:
+            workers = {row[0] for row in conn.execute("SELECT worker FROM buckets")}
+        assert second.worker in workers
+
+    def test_connection_is_reused_per_thread(self, tmp_path, clock):
+        """Test every thread opens the database only once."""
+        limiter = SharedRateLimiter(tmp_path / "ratelimit.sqlite", "host", 4.0)
+        limiter.try_acquire()
+        assert limiter._connection() is limiter._connection()
+        connections = []
+        thread = threading.Thread(
+            target=lambda: connections.append(limiter._connection())
+        )
+        thread.start()
+        thread.join()
+        assert connections[0] is not limiter._connection()
+
+    def test_keys_have_separate_budgets(self, tmp_path, clock):
+        """Test different keys do not share their budget."""
+        database = tmp_path / "ratelimit.sqlite"
+        first = SharedRateLimiter(database, "first", 1.0)
+        second = SharedRateLimiter(database, "second", 1.0)
+        first.try_acquire()
+        second.try_acquire()
+        clock[0] += 1.0
+        assert first.try_acquire() == 0
+        assert second.try_acquire() == 0
+        assert first.try_acquire() > 0
+
+    def test_provider_uses_shared_rate_limiter(self, tmp_path):
+        """Test the provider returns a shared rate limiter if configured."""
+        settings = StorageProviderSettings(
+            site_url="https://snakemake.readthedocs.io",
+            shared_rate_limit_db=tmp_path / "ratelimit.sqlite",
+        )
+        provider = StorageProvider(local_prefix=tmp_path, settings=settings)
+        limiter = provider.rate_limiter("mssp://library/file.txt", Operation.EXISTS)
+        assert isinstance(limiter, SharedRateLimiter)
+        assert limiter.rate == provider.default_max_requests_per_second()
+
+
+class TestPrefetcher:
+    """Test the background downloads of inputs."""
+
+    @staticmethod
+    def download(contents: bytes, started: Optional[threading.Event] = None):
+        """Return a download function writing the contents."""
+
+        def _download(path: pathlib.Path):
+            if started is not None:
+                started.set()
+            path.write_bytes(contents)
+
+        return _download
+
+    def test_prefetched_file_is_taken(self, tmp_path):
+        """Test a scheduled file can be taken after downloading."""
+        prefetcher = Prefetcher(tmp_path, max_workers=2)
+        started = threading.Event()
+        assert prefetcher.schedule(
+            "lib/file.txt", 8, self.download(b"contents", started)
+        )
+        started.wait()
+        taken = prefetcher.take("lib/file.txt")
+        assert taken is not None
+        path, _ = taken
+        assert path.read_bytes() == b"contents"
+        assert prefetcher.take("lib/file.txt") is None
+
+    def test_unscheduled_file_is_not_taken(self, tmp_path):
+        """Test a file that was not scheduled cannot be taken."""
+        assert Prefetcher(tmp_path, max_workers=1).take("lib/file.txt") is None
+
+    def test_queued_file_is_not_taken(self, tmp_path):
+        """Test a file still waiting for a worker is not waited for."""
+        prefetcher = Prefetcher(tmp_path, max_workers=1, disk_budget=10)
+        release = threading.Event()
+        prefetcher.schedule("a", 2, lambda path: release.wait())
+        prefetcher.schedule("b", 6, self.download(b"b"))
+        assert prefetcher.take("b") is None
+        assert prefetcher.schedule("c", 8, self.download(b"c"))
+        release.set()
+
+    def test_failed_download_is_not_taken(self, tmp_path):
+        """Test a failed download falls back to a regular download."""
+        started = threading.Event()
+
+        def fail(path: pathlib.Path):
+            started.set()
+            path.write_bytes(b"partial")
+            raise WorkflowError("failed")
+
+        prefetcher = Prefetcher(tmp_path, max_workers=1)
+        prefetcher.schedule("lib/file.txt", 8, fail)
+        started.wait()
+        assert prefetcher.take("lib/file.txt") is None
+        assert not (tmp_path / "lib/file.txt").exists()
+
+    def test_disk_budget_is_respected(self, tmp_path):
+        """Test files are only scheduled within the disk budget."""
+        prefetcher = Prefetcher(tmp_path, max_workers=1, disk_budget=10)
+        started = threading.Event()
+        assert prefetcher.schedule("a", 6, self.download(b"a", started))
+        assert not prefetcher.schedule("b", 6, self.download(b"b"))
+        started.wait()
+        assert prefetcher.take("a") is not None
+        assert prefetcher.schedule("b", 6, self.download(b"b"))
+
+    def test_discarded_file_is_removed(self, tmp_path):
+        """Test a discarded file is deleted and no longer counts for the budget."""
+        prefetcher = Prefetcher(tmp_path, max_workers=1, disk_budget=10)
+        started = [threading.Event(), threading.Event()]
+        prefetcher.schedule("a", 6, self.download(b"a", started[0]))
+        started[0].wait()
+        prefetcher.discard("a")
+        assert prefetcher.take("a") is None
+        assert prefetcher.schedule("b", 6, self.download(b"b", started[1]))
+        # The single worker only starts on b after finishing a
+        started[1].wait()
+        assert not (tmp_path / "a").exists()
+
+    def test_close_removes_untaken_files(self, tmp_path):
+        """Test closing the prefetcher removes its staging directory."""
+        staging_dir = tmp_path / "staging"
+        prefetcher = Prefetcher(staging_dir, max_workers=1)
+        started = threading.Event()
+        prefetcher.schedule("lib/file.txt", 8, self.download(b"contents", started))
+        started.wait()
+        prefetcher.close()
+        assert not staging_dir.exists()
+        assert not prefetcher.schedule("lib/other.txt", 8, self.download(b"other"))
+
+    def test_stale_staging_dirs_are_removed(self, tmp_path):
+        """Test only staging directories of ended processes on this host are removed."""
+        ended = subprocess.Popen([sys.executable, "-c", "pass"])
+        ended.wait()
+        host = socket.gethostname()
+        stale = tmp_path / f"{host}-{ended.pid}-abc"
+        running = make_staging_dir(tmp_path)
+        other_host = tmp_path / f"other.{host}-{ended.pid}-abc"
+        for path in [stale, other_host]:
+            path.mkdir()
+        remove_stale_staging_dirs(tmp_path)
+        assert not stale.exists()
+        assert running.exists()
+        assert other_host.exists()
+
+    def test_cleanup_discards_prefetched_file(self, tmp_path, monkeypatch):
+        """Test a prefetched file that was never retrieved is discarded."""
+        settings = StorageProviderSettings(
+            site_url="https://snakemake.readthedocs.io", prefetch=True
+        )
+        provider = StorageProvider(local_prefix=tmp_path, settings=settings)
+        obj = provider.object("mssp://library/file.txt")
+        monkeypatch.setattr(obj, "_download_content", self.download(b"contents"))
+        provider.prefetch(obj, 8)
+        obj.cleanup()
+        assert provider.take_prefetched(obj) is None
+
+    def test_prefetch_is_throttled(self, tmp_path, monkeypatch):
+        """Test background downloads go through the rate limiter of the site."""
+        settings = StorageProviderSettings(
+            site_url="https://snakemake.readthedocs.io", prefetch=True
+        )
+        provider = StorageProvider(local_prefix=tmp_path, settings=settings)
+        obj = provider.object("mssp://library/file.txt")
+        throttled = []
+        monkeypatch.setattr(
+            provider, "throttle", lambda query, operation: throttled.append(query)
+        )
+        started = threading.Event()
+        monkeypatch.setattr(
+            obj, "_download_content", self.download(b"contents", started)
+        )
+        provider.prefetch(obj, 8)
+        started.wait()
+        assert throttled == [obj.query]
+
+    def test_only_retrieved_inputs_are_prefetched(self, tmp_path, monkeypatch):
+        """Test inventoried inputs are only prefetched once Snakemake retrieves them."""
+        settings = StorageProviderSettings(
+            site_url="https://snakemake.readthedocs.io", prefetch=True
+        )
+        provider = StorageProvider(local_prefix=tmp_path, settings=settings)
+        objects = [provider.object(f"mssp://library/{i}.txt") for i in range(3)]
+        downloads: List[str] = []
+        for obj in objects:
+            monkeypatch.setattr(
+                obj,
+                "_download_content",
+                lambda path, obj=obj: downloads.append(obj.query) or path.touch(),
+            )
+            provider.add_prefetch_candidate(obj, 8)
+        assert provider._prefetcher is None
+
+        async def retrieve():
+            # The inputs of jobs that run are retrieved concurrently
+            await asyncio.gather(*(obj.managed_retrieve() for obj in objects[:2]))
+
+        events: List[str] = []
+        prefetch = provider.prefetch
+        monkeypatch.setattr(
+            provider,
+            "prefetch",
+            lambda obj, size: events.append("prefetch") or prefetch(obj, size),
+        )
+        retrieve_object = StorageObject.retrieve_object
+        monkeypatch.setattr(
+            StorageObject,
+            "retrieve_object",
+            lambda self: events.append("retrieve") or retrieve_object(self),
+        )
+        asyncio.run(retrieve())
+        assert events == ["prefetch", "prefetch", "retrieve", "retrieve"]
+        assert sorted(downloads) == [objects[0].query, objects[1].query]
+        assert all(obj.local_path().exists() for obj in objects[:2])
+
+    def test_prefetch_is_disabled_by_default(self):
+        """Test the provider does not prefetch unless enabled."""
+        with storage_provider() as provider:
+            obj = provider.object("mssp://library/file.txt")
+            provider.prefetch(obj, 10)
+            assert provider.take_prefetched(obj) is None
+
+
+class TestVersions:
+    """Test the version-pinned queries."""
+
+    def test_parse_version_label(self):
+        """Test parsing a version label."""
+        assert VersionSelector.parse("3") == VersionSelector(label="3.0")
+        assert VersionSelector.parse("3.1").local_name() == "@3.1"
+
+    def test_parse_version_time(self):
+        """Test parsing a version time, naive times are UTC."""
+        selector = VersionSelector.parse("2024-05-01T12:00:00")
+        assert selector == VersionSelector.parse("2024-05-01T14:00:00+02:00")
+        assert selector.local_name() == "@20240501T120000Z"
+
+    def test_version_id(self):
+        """Test the version ID is derived from the label."""
+        assert VersionInfo("3.1", 0, 0).id == 3 * 512 + 1
+
+    def test_resolve_version_at_time(self):
+        """Test the version current at a time is selected."""
+        history = [VersionInfo("1.0", 100, 1), VersionInfo("2.0", 200, 2)]
+        current = VersionInfo("3.0", 300, 3)
+        at = VersionSelector.parse("1970-01-01T00:04:10Z")
+        assert at.resolve(current, history) == history[1]
+        assert VersionSelector.parse("1970-01-01").resolve(current, history) is None
+        assert VersionSelector(label="3.0").resolve(current, history) == current
+
+    def test_version_cache(self, tmp_path):
+        """Test version metadata survives in the cache."""
+        info = VersionInfo("3.0", 300.0, 3)
+        VersionCache(tmp_path).put("host/library/@3.0/file.txt", info)
+        assert VersionCache(tmp_path).get("host/library/@3.0/file.txt") == info
+        assert VersionCache(tmp_path).get("host/library/@2.0/file.txt") is None
+
+    def test_versions_are_stored_side_by_side(self):
+        """Test the version is part of the local path."""
+        with storage_provider() as provider:
+            obj = provider.object("mssp://library/folder/file.txt?version=3.0")
+            assert obj.local_suffix() == (
+                "snakemake.readthedocs.io/library/folder/@3.0/file.txt"
+            )
+
+    def test_cached_version_is_not_revalidated(self, monkeypatch):
+        """Test the metadata of a cached version is used without requests."""
+        with storage_provider() as provider:
+            obj = provider.object("mssp://library/file.txt?version=3.0")
+            provider.version_cache.put(obj.local_suffix(), VersionInfo("3.0", 300.0, 3))
+
+            def request(*args, **kwargs):
+                raise AssertionError("cached versions must not be revalidated")
+
+            monkeypatch.setattr(obj.site.session, "request", request)
+            assert obj.exists()
+            assert obj.mtime() == 300.0
+            assert obj.size() == 3
+
+    def test_cached_version_content_is_not_downloaded(self, monkeypatch):
+        """Test a version is downloaded once, even if its local copy is deleted."""
+        with storage_provider() as provider:
+            obj = provider.object("mssp://library/file.txt?version=3.0")
+            info = VersionInfo("3.0", 300.0, 2)
+            monkeypatch.setattr(obj, "_fetch_version_info", lambda: info)
+
+            def download(filename, local_path, mtime=None, version_id=None):
+                local_path.write_bytes(b"v3")
+
+            monkeypatch.setattr(obj, "_download_file", download)
+            obj.retrieve_object()
+            obj.local_path().unlink()
+
+            def request(*args, **kwargs):
+                raise AssertionError("cached versions must not be downloaded again")
+
+            monkeypatch.setattr(obj.site.session, "request", request)
+            monkeypatch.setattr(obj, "_download_file", request)
+            obj.retrieve_object()
+            assert obj.local_path().read_bytes() == b"v3"
+
+    def test_current_version_is_downloaded_directly(self, monkeypatch):
+        """Test the current version is downloaded without trying the history."""
+        with storage_provider() as provider:
+            obj = provider.object("mssp://library/file.txt?version=3.0")
+            current = VersionInfo("3.0", 300.0, 2, current=True)
+            monkeypatch.setattr(obj, "_current_version_info", lambda: current)
+            version_ids: List[Optional[int]] = []
+
+            def download(filename, local_path, mtime=None, version_id=None):
+                version_ids.append(version_id)
+                local_path.write_bytes(b"v3")
+
+            monkeypatch.setattr(obj, "_download_file", download)
+            obj.retrieve_object()
+            assert version_ids == [None]
+            cached = provider.version_cache.get(obj.local_suffix())
+            assert cached is not None
+            assert not cached.current
+
+    def test_storing_version_raises(self):
+        """Test pinned versions cannot be stored."""
+        with storage_provider() as provider:
+            obj = provider.object("mssp://library/file.txt?version=3.0")
+            with pytest.raises(WorkflowError):
+                obj.store_object()